@@ -21,16 +21,114 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
 }
+# log requests that send more SQL statements than this to the database (0 disables the check)
+app.config["QUERY_BUDGET_PER_REQUEST"] = int(os.environ.get("QUERY_BUDGET_PER_REQUEST", 0))
+
+# configure the background download worker pool and its database-backed queue
+# DOWNLOAD_MAX_WORKERS is the number of downloads one process runs concurrently on its event loop
+app.config["DOWNLOAD_MAX_WORKERS"] = int(os.environ.get("DOWNLOAD_MAX_WORKERS", 100))
+app.config["DOWNLOAD_BLOCKING_THREADS"] = int(os.environ.get("DOWNLOAD_BLOCKING_THREADS", 4))
+app.config["DOWNLOAD_POLL_INTERVAL"] = float(os.environ.get("DOWNLOAD_POLL_INTERVAL", 5))
+app.config["DOWNLOAD_LEASE_SECONDS"] = int(os.environ.get("DOWNLOAD_LEASE_SECONDS", 60))
+app.config["DOWNLOAD_MAX_ATTEMPTS"] = int(os.environ.get("DOWNLOAD_MAX_ATTEMPTS", 3))
+# Downloads run in the standalone worker (python -m worker); set this to also run them in the web process
+app.config["DOWNLOAD_EMBEDDED_WORKERS"] = os.environ.get("DOWNLOAD_EMBEDDED_WORKERS", "0") == "1"
+
+# configure the pooled HTTP connections used to fetch from portals (timeouts in seconds)
+app.config["PORTAL_CONNECTIONS_PER_PORTAL"] = int(os.environ.get("PORTAL_CONNECTIONS_PER_PORTAL", 10))
+app.config["PORTAL_CONNECT_TIMEOUT"] = float(os.environ.get("PORTAL_CONNECT_TIMEOUT", 10))
+app.config["PORTAL_READ_TIMEOUT"] = float(os.environ.get("PORTAL_READ_TIMEOUT", 60))
+# a download gives up on a portal whose limits haven't allowed it a request within PORTAL_SLOT_WAIT_TIMEOUT seconds
+app.config["PORTAL_SLOT_WAIT_TIMEOUT"] = float(os.environ.get("PORTAL_SLOT_WAIT_TIMEOUT", 600))
+app.config["PORTAL_KEEPALIVE_TIMEOUT"] = float(os.environ.get("PORTAL_KEEPALIVE_TIMEOUT", 30))
+# large date ranges are fetched as chunks of DOWNLOAD_CHUNK_DAYS days, at most DOWNLOAD_CHUNK_CONCURRENCY at once per portal
+app.config["DOWNLOAD_CHUNK_DAYS"] = int(os.environ.get("DOWNLOAD_CHUNK_DAYS", 7))
+app.config["DOWNLOAD_CHUNK_CONCURRENCY"] = int(os.environ.get("DOWNLOAD_CHUNK_CONCURRENCY", 4))
+# transient chunk failures are retried with exponential backoff and full jitter (delays in seconds)
+app.config["DOWNLOAD_CHUNK_RETRIES"] = int(os.environ.get("DOWNLOAD_CHUNK_RETRIES", 4))
+app.config["DOWNLOAD_RETRY_BASE_DELAY"] = float(os.environ.get("DOWNLOAD_RETRY_BASE_DELAY", 1))
+app.config["DOWNLOAD_RETRY_MAX_DELAY"] = float(os.environ.get("DOWNLOAD_RETRY_MAX_DELAY", 30))
+# progress is written when it moves DOWNLOAD_PROGRESS_MIN_DELTA points or DOWNLOAD_PROGRESS_MIN_INTERVAL seconds pass,
+# batched for all running downloads every DOWNLOAD_PROGRESS_FLUSH_INTERVAL seconds
+app.config["DOWNLOAD_PROGRESS_MIN_DELTA"] = int(os.environ.get("DOWNLOAD_PROGRESS_MIN_DELTA", 5))
+app.config["DOWNLOAD_PROGRESS_MIN_INTERVAL"] = float(os.environ.get("DOWNLOAD_PROGRESS_MIN_INTERVAL", 10))
+app.config["DOWNLOAD_PROGRESS_FLUSH_INTERVAL"] = float(os.environ.get("DOWNLOAD_PROGRESS_FLUSH_INTERVAL", 1))
+# live progress of running downloads, shared by every process on the host (SQLite file in WAL mode)
+app.config["PROGRESS_STORE_PATH"] = os.environ.get("PROGRESS_STORE_PATH", os.path.join(app.instance_path, "progress.db"))
+# downloads per page of /download-history and /api/downloads (?limit= may ask for up to the max)
+app.config["DOWNLOAD_HISTORY_PAGE_SIZE"] = int(os.environ.get("DOWNLOAD_HISTORY_PAGE_SIZE", 50))
+app.config["DOWNLOAD_HISTORY_MAX_PAGE_SIZE"] = int(os.environ.get("DOWNLOAD_HISTORY_MAX_PAGE_SIZE", 200))
+# password hashes run in a pool of PASSWORD_HASH_WORKERS processes; requests beyond
+# PASSWORD_HASH_MAX_PENDING running or queued hashes are turned away with a 429
+app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+app.config["PASSWORD_HASH_MAX_PENDING"] = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 8))
+# roles of recently seen users are cached per process (LRU) and rechecked every IDENTITY_CACHE_TTL seconds;
+# role changes and deletions reach every process through a shared version counter, which each process
+# reads at most every IDENTITY_CACHE_VERSION_INTERVAL seconds
+app.config["IDENTITY_CACHE_SIZE"] = int(os.environ.get("IDENTITY_CACHE_SIZE", 1024))
+app.config["IDENTITY_CACHE_TTL"] = float(os.environ.get("IDENTITY_CACHE_TTL", 5))
+app.config["IDENTITY_CACHE_VERSION_INTERVAL"] = float(os.environ.get("IDENTITY_CACHE_VERSION_INTERVAL", 1))
+# the portal list is cached per process and rechecked against the database every PORTAL_CACHE_TTL seconds
+app.config["PORTAL_CACHE_TTL"] = float(os.environ.get("PORTAL_CACHE_TTL", 30))
+# identical download requests reuse a finished result for DOWNLOAD_RESULT_CACHE_TTL seconds (portals may override it);
+# the DOWNLOAD_RESULT_CACHE_SIZE most recently used results are kept
+app.config["DOWNLOAD_RESULT_CACHE_TTL"] = int(os.environ.get("DOWNLOAD_RESULT_CACHE_TTL", 600))
+app.config["DOWNLOAD_RESULT_CACHE_SIZE"] = int(os.environ.get("DOWNLOAD_RESULT_CACHE_SIZE", 1000))
+# days already fetched are reused by later downloads, except the DOWNLOAD_MUTABLE_WINDOW_DAYS most recent
+# days, whose data the portal may still change; those are fetched again until they have settled
+app.config["DOWNLOAD_MUTABLE_WINDOW_DAYS"] = int(os.environ.get("DOWNLOAD_MUTABLE_WINDOW_DAYS", 3))
+# recorded days are dropped DOWNLOAD_COVERAGE_RETENTION_DAYS after they were fetched (and fetched again if needed)
+app.config["DOWNLOAD_COVERAGE_RETENTION_DAYS"] = int(os.environ.get("DOWNLOAD_COVERAGE_RETENTION_DAYS", 90))
+# result files are kept outside the static folder, so they are only served through the authenticated endpoint
+app.config["DOWNLOAD_STORAGE_DIR"] = os.environ.get("DOWNLOAD_STORAGE_DIR", os.path.join(app.instance_path, "downloads"))
+# how new result files are stored: none, gzip or zstd (zstd needs the zstandard package); compressed files
+# take less disk but are decompressed on the fly for clients that don't accept the encoding (curl, wget,
+# scripts), which then get no Range support for resuming, and nginx's X-Accel-Redirect only serves plain files
+app.config["DOWNLOAD_STORAGE_COMPRESSION"] = os.environ.get("DOWNLOAD_STORAGE_COMPRESSION", "none")
+# result files are sent with sendfile; behind nginx, set DOWNLOAD_FILE_ACCEL_PREFIX to an internal
+# location aliased to DOWNLOAD_STORAGE_DIR and nginx sends them instead (X-Accel-Redirect)
+app.config["DOWNLOAD_FILE_ACCEL_PREFIX"] = os.environ.get("DOWNLOAD_FILE_ACCEL_PREFIX", "")
+app.config["DOWNLOAD_FILE_MAX_AGE"] = int(os.environ.get("DOWNLOAD_FILE_MAX_AGE", 3600))
+# most download ids accepted by one /api/download-status/batch request
+app.config["DOWNLOAD_STATUS_BATCH_LIMIT"] = int(os.environ.get("DOWNLOAD_STATUS_BATCH_LIMIT", 500))
+# /api/download-events checks for changes every DOWNLOAD_EVENTS_INTERVAL seconds; each stream holds a
+# gunicorn thread, so it ends after DOWNLOAD_EVENTS_MAX_SECONDS and the browser reconnects, and at most
+# DOWNLOAD_EVENTS_MAX_STREAMS are open per process (keep it below gunicorn's --threads); past that
+# browsers poll instead
+app.config["DOWNLOAD_EVENTS_INTERVAL"] = float(os.environ.get("DOWNLOAD_EVENTS_INTERVAL", 1))
+app.config["DOWNLOAD_EVENTS_REFRESH_SECONDS"] = float(os.environ.get("DOWNLOAD_EVENTS_REFRESH_SECONDS", 15))
+app.config["DOWNLOAD_EVENTS_MAX_SECONDS"] = float(os.environ.get("DOWNLOAD_EVENTS_MAX_SECONDS", 300))
+app.config["DOWNLOAD_EVENTS_MAX_STREAMS"] = int(os.environ.get("DOWNLOAD_EVENTS_MAX_STREAMS", 4))
+
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 
-# initialize the app with the extension, flask-sqlalchemy >= 3.0.x
-db.init_app(app)
+# Make sure to import the models here so they are registered with db.metadata;
+# the schema itself is created and upgraded by `flask init-db` / migrations.py
+import models  # noqa: F401
+
+
+def configure_app(config=None):
+    """
+    Finish configuring the module's application, with config overriding the settings read from
+    the environment, and return it
+    This is not a factory: there is one application per process, as the routes are registered on
+    it at import. Call it once at startup, before the first request; later calls return the same
+    application and may not pass config. Nothing here connects to the database or touches its schema
+    """
+    if 'sqlalchemy' in app.extensions:
+        if config:
+            raise RuntimeError("The application is already configured; pass config on the first configure_app() call")
+        return app
+    if config:
+        app.config.from_mapping(config)
+    # initialize the app with the extension, flask-sqlalchemy >= 3.0.x
+    db.init_app(app)
+    return app
 
-with app.app_context():
-    # Make sure to import the models here or their tables won't be created
-    import models  # noqa: F401
-    db.create_all()
 
 # Import routes after app is created to avoid circular imports
 from routes import *
+from migrations import init_db_command
+
+app.cli.add_command(init_db_command)
@@ -0,0 +1,68 @@
+"""
+Cold start benchmark
+
+Boots the app in fresh interpreters, the way each gunicorn worker or test run
+does, and reports how long it takes until the first request is served:
+
+    python -m benchmark_startup --runs 10
+    DATABASE_URL=postgresql://... python -m benchmark_startup --runs 10
+
+--with-schema also times a boot that runs db.create_all() first, as app.py
+used to on every import, for comparison.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+_BOOT = '''
+import json, time
+started = time.perf_counter()
+from app import app, configure_app, db
+configure_app()
+imported = time.perf_counter()
+if {with_schema}:
+    with app.app_context():
+        db.create_all()
+schema = time.perf_counter()
+app.test_client().get('/')
+served = time.perf_counter()
+print(json.dumps({{
+    'import': imported - started,
+    'schema': schema - imported,
+    'first_request': served - schema,
+    'total': served - started
+}}))
+'''
+
+
+def boot_once(with_schema):
+    """Boot the app in a new interpreter and return its timings in seconds"""
+    result = subprocess.run(
+        [sys.executable, '-c', _BOOT.format(with_schema=with_schema)],
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def report(label, runs):
+    print(label)
+    for phase in ('import', 'schema', 'first_request', 'total'):
+        timings = [run[phase] * 1000 for run in runs]
+        print(f'  {phase:<14} median {statistics.median(timings):8.1f} ms   min {min(timings):8.1f} ms   max {max(timings):8.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure app cold start time')
+    parser.add_argument('--runs', type=int, default=5, help='number of boots to time')
+    parser.add_argument('--with-schema', action='store_true',
+                        help='also time boots that create the schema on startup')
+    args = parser.parse_args()
+
+    report(f'Cold start over {args.runs} runs', [boot_once(False) for _ in range(args.runs)])
+    if args.with_schema:
+        report(f'Cold start with db.create_all() over {args.runs} runs', [boot_once(True) for _ in range(args.runs)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Per-day coverage index for delta downloads
+
+Every chunk fetched from a portal is also recorded day by day, under the
+credential, facility and download type it was fetched for. A later download
+of an overlapping range reuses the days already recorded and only fetches
+the rest, so pulling the last 30 days every morning fetches a few days rather
+than all 30.
+
+Portals may still change their most recent data, so a recorded day only
+counts once it had settled when it was fetched: it must have been at least
+DOWNLOAD_MUTABLE_WINDOW_DAYS old at the time. Days fetched earlier than that
+are fetched again and overwritten.
+
+Days are recorded per credential, so data fetched with one login is never
+handed to another.
+
+Recorded days are kept for DOWNLOAD_COVERAGE_RETENTION_DAYS after they were
+fetched; the worker heartbeat prunes older days, and any left behind by
+deleted credentials or portals, every PRUNE_INTERVAL_SECONDS.
+"""
+import json
+import logging
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import exists, or_
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import CoverageDay, Credential, Portal
+
+# How often the worker heartbeat prunes the index
+PRUNE_INTERVAL_SECONDS = 3600
+
+
+def _item_day(item):
+    """The day an item belongs to, from its "date" field, or None if it has none"""
+    value = item.get('date') if isinstance(item, dict) else None
+    if not isinstance(value, str):
+        return None
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        return None
+
+def _coverage_filter(credential_id, facility_username, download_type):
+    return CoverageDay.query.filter_by(
+        credential_id=credential_id,
+        facility_username=facility_username or '',
+        download_type=download_type
+    )
+
+
+def covered_days(credential_id, facility_username, download_type, start_date, end_date):
+    """Return the days of the range whose recorded data had settled when it was fetched"""
+    window = app.config['DOWNLOAD_MUTABLE_WINDOW_DAYS']
+    rows = _coverage_filter(credential_id, facility_username, download_type).filter(
+        CoverageDay.day.between(start_date, end_date)
+    ).with_entities(CoverageDay.day, CoverageDay.fetched_at)
+    days = {day for day, fetched_at in rows if (fetched_at.date() - day).days >= window}
+    db.session.rollback()
+    return days
+
+def load_covered_items(credential_id, facility_username, download_type, start_date, end_date):
+    """Return the recorded items of a fully covered range, in date order"""
+    rows = _coverage_filter(credential_id, facility_username, download_type).filter(
+        CoverageDay.day.between(start_date, end_date)
+    ).order_by(CoverageDay.day).with_entities(CoverageDay.day, CoverageDay.items_json).all()
+    db.session.rollback()
+
+    expected = (end_date - start_date).days + 1
+    if len(rows) != expected:
+        raise RuntimeError(f"Coverage of {start_date}..{end_date} changed while the download was running")
+    items = []
+    for _, items_json in rows:
+        items.extend(json.loads(items_json))
+    return items
+
+def record_coverage(portal_id, credential_id, facility_username, download_type, chunk_start, chunk_end, items):
+    """
+    Record the items of a freshly fetched chunk day by day, replacing what was recorded before
+    Days without items are recorded as empty; a chunk with items that can't be placed on one of
+    its days is not recorded at all, as its days couldn't be reassembled faithfully
+    """
+    by_day = defaultdict(list)
+    for item in items:
+        day = _item_day(item)
+        if day is None or not chunk_start <= day <= chunk_end:
+            logging.debug("Not recording coverage of %s..%s: an item has no date in range", chunk_start, chunk_end)
+            return False
+        by_day[day].append(item)
+
+    days = [chunk_start + timedelta(days=offset) for offset in range((chunk_end - chunk_start).days + 1)]
+    for _ in range(5):
+        now = datetime.utcnow()
+        _coverage_filter(credential_id, facility_username, download_type).filter(
+            CoverageDay.day.between(chunk_start, chunk_end)
+        ).delete(synchronize_session=False)
+        db.session.add_all([
+            CoverageDay(
+                portal_id=portal_id,
+                credential_id=credential_id,
+                facility_username=facility_username or '',
+                download_type=download_type,
+                day=day,
+                item_count=len(by_day[day]),
+                items_json=json.dumps(by_day[day]),
+                fetched_at=now
+            )
+            for day in days
+        ])
+        try:
+            db.session.commit()
+            return True
+        except IntegrityError:
+            # Another download recorded some of these days at the same moment; replace them again
+            db.session.rollback()
+    raise RuntimeError(f"Could not record coverage of {chunk_start}..{chunk_end}")
+
+def prune_coverage():
+    """
+    Delete the days fetched more than DOWNLOAD_COVERAGE_RETENTION_DAYS ago, and those of deleted credentials or portals
+    Returns the number of days deleted
+    """
+    cutoff = datetime.utcnow() - timedelta(days=app.config['DOWNLOAD_COVERAGE_RETENTION_DAYS'])
+    pruned = CoverageDay.query.filter(or_(
+        CoverageDay.fetched_at < cutoff,
+        ~exists().where(Credential.id == CoverageDay.credential_id),
+        ~exists().where(Portal.id == CoverageDay.portal_id)
+    )).delete(synchronize_session=False)
+    db.session.commit()
+    if pruned:
+        logging.info("Pruned %s days from the coverage index", pruned)
+    return pruned
@@ -0,0 +1,230 @@
+"""
+Download result files
+
+Results are written to DOWNLOAD_STORAGE_DIR as they arrive instead of being
+assembled in memory first: the document's header fields go out up front and
+the items array is appended to item by item, in compact JSON.
+
+Finished files are content-addressed: they are named after a hash of their
+payload, so downloads that fetched the same data share one file. Each
+StoredFile row counts the downloads pointing at its file, and files nobody
+points at any more are collected.
+
+DOWNLOAD_STORAGE_COMPRESSION picks how new files are stored: 'none' (the
+default), 'gzip' or 'zstd' (needs the zstandard package). A file keeps the
+compression it was written with, recorded on its Download row, and is read
+back accordingly. Compressed files save disk, but clients that don't accept
+their encoding get them decompressed on the fly, without Range support.
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+from sqlalchemy import event, update
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import Download, StoredFile
+
+# Keys are sorted so the same data is written, and hashed, the same way whatever order the portal sent it in
+_encode = json.JSONEncoder(separators=(',', ':'), sort_keys=True).encode
+
+# File name suffix and HTTP Content-Encoding of each storage compression
+COMPRESSIONS = {
+    'none': ('.json', None),
+    'gzip': ('.json.gz', 'gzip'),
+    'zstd': ('.json.zst', 'zstd'),
+}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("zstd storage needs the zstandard package (pip install zstandard)")
+    return zstandard
+
+def _open_compressed_writer(path, compression):
+    """Open path for writing bytes through the given compression"""
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    if compression == 'zstd':
+        return _zstandard().ZstdCompressor().stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+def open_stored_file(path, compression):
+    """Open a stored result file for reading its uncompressed JSON bytes"""
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'zstd':
+        return _zstandard().ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+def content_encoding(compression):
+    """The HTTP Content-Encoding that matches a stored file's compression, or None if it is stored plain"""
+    return COMPRESSIONS.get(compression or 'none', COMPRESSIONS['none'])[1]
+
+
+def downloads_dir():
+    return app.config['DOWNLOAD_STORAGE_DIR']
+
+def resolve_download_file(file_path):
+    """Return the location on disk of a download's file_path, or None if it points outside the downloads folder"""
+    directory = downloads_dir()
+    path = os.path.realpath(os.path.join(directory, os.path.basename(file_path)))
+    if os.path.dirname(path) != os.path.realpath(directory):
+        return None
+    return path
+
+
+class DownloadFileWriter:
+    """
+    Streams one JSON document of the form {<header fields>, "items": [...]} to a temporary file
+    While writing it hashes the canonical payload (everything but the header's timestamp), which
+    names the file in the content-addressed store
+    """
+
+    def __init__(self, directory, header, compression='none'):
+        self.directory = directory
+        self.compression = compression
+        self.item_count = 0
+        self.content_size = 0
+        self.file_size = None
+        self.content_hash = None
+        self.file_name = None
+        self._hash = hashlib.sha256()
+        self._hash.update(_encode({key: value for key, value in header.items() if key != 'timestamp'}).encode())
+        fd, self._partial_path = tempfile.mkstemp(suffix='.part', dir=directory)
+        os.close(fd)
+        self._file = io.TextIOWrapper(_open_compressed_writer(self._partial_path, compression), encoding='utf-8')
+        self._write('{')
+        for key, value in header.items():
+            self._write(f'{_encode(key)}:{_encode(value)},')
+        self._write('"items":[')
+
+    def _write(self, text):
+        # The encoder escapes non-ASCII characters, so characters and bytes are the same count
+        self._file.write(text)
+        self.content_size += len(text)
+
+    def write_items(self, items):
+        """Append items to the document's items array"""
+        for item in items:
+            if self.item_count:
+                self._write(',')
+            encoded = _encode(item)
+            self._write(encoded)
+            self._hash.update(b'\n' + encoded.encode())
+            self.item_count += 1
+
+    def close(self):
+        """Finish the document; returns the name it will be stored under"""
+        self._write(']}')
+        self._file.close()
+        self.file_size = os.path.getsize(self._partial_path)
+        self.content_hash = self._hash.hexdigest()
+        self.file_name = f"{self.content_hash}{COMPRESSIONS[self.compression][0]}"
+        return self.file_name
+
+    def publish(self):
+        """
+        Move the finished document into the store, or drop it if the same content is already there
+        Call only once the file is referenced in the database, so it cannot be collected meanwhile
+        """
+        path = os.path.join(self.directory, self.file_name)
+        if os.path.exists(path):
+            os.remove(self._partial_path)
+        else:
+            os.replace(self._partial_path, path)
+
+    def abort(self):
+        """Throw away a partly written document"""
+        self._file.close()
+        if os.path.exists(self._partial_path):
+            os.remove(self._partial_path)
+
+
+def open_download_file(header):
+    """Start a result file, compressed as configured"""
+    directory = downloads_dir()
+    os.makedirs(directory, exist_ok=True)
+
+    compression = app.config['DOWNLOAD_STORAGE_COMPRESSION']
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown DOWNLOAD_STORAGE_COMPRESSION {compression!r}, expected one of {', '.join(COMPRESSIONS)}")
+    return DownloadFileWriter(directory, header, compression)
+
+
+def record_download_file(download_id, file_path, writer):
+    """
+    Point a download at its result file and take a reference on the file for it
+    A download that already has a file (e.g. when a reclaimed job ran twice) keeps it
+    """
+    for _ in range(5):
+        attached = Download.query.filter(Download.id == download_id, Download.file_path.is_(None)).update({
+            'file_path': file_path,
+            'compression': writer.compression,
+            'file_size': writer.file_size,
+            'content_size': writer.content_size
+        }, synchronize_session=False)
+        if not attached:
+            db.session.rollback()
+            return False
+        
+        referenced = StoredFile.query.filter_by(file_path=file_path).update(
+            {'ref_count': StoredFile.ref_count + 1}, synchronize_session=False
+        )
+        if not referenced:
+            db.session.add(StoredFile(
+                file_path=file_path,
+                content_hash=writer.content_hash,
+                compression=writer.compression,
+                file_size=writer.file_size,
+                content_size=writer.content_size,
+                ref_count=1
+            ))
+        try:
+            db.session.commit()
+            return True
+        except IntegrityError:
+            # Another download stored the same content first; take a reference on its row instead
+            db.session.rollback()
+    raise RuntimeError(f"Could not record the stored file {file_path}")
+
+def collect_unreferenced_files(limit=100):
+    """
+    Delete stored files that no download points at any more; returns how many were removed
+    The row is deleted before the file, in the same transaction, so a download taking a new
+    reference waits on the row lock and then creates the file afresh
+    """
+    file_paths = [
+        file_path for (file_path,) in
+        db.session.query(StoredFile.file_path).filter(StoredFile.ref_count <= 0).limit(limit)
+    ]
+    db.session.rollback()
+    
+    removed = 0
+    for file_path in file_paths:
+        deleted = StoredFile.query.filter(
+            StoredFile.file_path == file_path, StoredFile.ref_count <= 0
+        ).delete(synchronize_session=False)
+        path = resolve_download_file(file_path)
+        if deleted and path and os.path.exists(path):
+            os.remove(path)
+            removed += 1
+        db.session.commit()
+    return removed
+
+
+@event.listens_for(Download, 'after_delete')
+def release_download_file(mapper, connection, download):
+    """Drop a deleted download's reference on its stored file"""
+    if download.file_path:
+        connection.execute(
+            update(StoredFile.__table__)
+            .where(StoredFile.__table__.c.file_path == download.file_path)
+            .values(ref_count=StoredFile.__table__.c.ref_count - 1)
+        )
@@ -2,128 +2,524 @@ import os
 import time
 import json
 import random
+import socket
+import asyncio
+import logging
 import requests
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 import threading
-from app import db
-from models import Download, Credential, Portal
+from sqlalchemy import and_, func, or_
+from app import app, db
+from models import Download, DownloadChunk, Credential, Portal, PortalRequestSlot
+from fetch_engine import get_fetch_engine, is_transient_error, run_blocking
+from portal_throttle import download_cap, portal_request_slot, reclaim_expired_slots
+from portal_cache import get_portals
+from progress import progress_reporter
+from download_output import collect_unreferenced_files, open_download_file, record_download_file
+from result_cache import remember_download_result
+from coverage_index import PRUNE_INTERVAL_SECONDS, covered_days, load_covered_items, prune_coverage, record_coverage
+
+
+def claim_next_download(worker_id, lease_seconds):
+    """
+    Claim the oldest scheduled download for this worker
+    Postgres hands out rows with SELECT ... FOR UPDATE SKIP LOCKED; SQLite ignores
+    the row lock, so the claim is made safe by a conditional UPDATE on the lease
+    Portals already running (or holding leases on) as many downloads as their limits can
+    serve at once are skipped, whether the limit is max_concurrent_requests or a rate
+    limit, so one throttled portal cannot take every slot from the others
+    Returns the claimed download id or None when the queue is empty
+    """
+    now = datetime.utcnow()
+    claimable = [
+        Download.status == 'scheduled',
+        or_(Download.lease_expires_at.is_(None), Download.lease_expires_at < now)
+    ]
+    caps = {
+        portal.id: download_cap(portal.rate_limit, portal.rate_limit_burst, portal.max_concurrent_requests)
+        for portal in get_portals()
+    }
+    running = db.session.query(Download.portal_id, func.count(Download.id)).filter(
+        Download.portal_id.in_([portal_id for portal_id, cap in caps.items() if cap]),
+        or_(
+            Download.status == 'in_progress',
+            and_(Download.status == 'scheduled', Download.lease_expires_at >= now)
+        )
+    ).group_by(Download.portal_id)
+    saturated_portals = [portal_id for portal_id, count in running if count >= caps[portal_id]]
+    candidate_ids = [
+        row.id for row in db.session.query(Download.id)
+        .filter(*claimable, Download.portal_id.notin_(saturated_portals))
+        .order_by(Download.created_at, Download.id)
+        .limit(5)
+        .with_for_update(skip_locked=True)
+    ]
+    
+    for download_id in candidate_ids:
+        claimed = Download.query.filter(Download.id == download_id, *claimable).update({
+            'lease_owner': worker_id,
+            'lease_expires_at': now + timedelta(seconds=lease_seconds),
+            'attempts': Download.attempts + 1
+        }, synchronize_session=False)
+        if claimed:
+            db.session.commit()
+            return download_id
+    
+    db.session.commit()
+    return None
+
+def renew_leases(worker_id, download_ids, lease_seconds):
+    """Heartbeat: extend the leases this worker still holds, and the portal request slots of those downloads"""
+    if not download_ids:
+        return 0
+    expires_at = datetime.utcnow() + timedelta(seconds=lease_seconds)
+    renewed = Download.query.filter(
+        Download.id.in_(download_ids),
+        Download.lease_owner == worker_id
+    ).update({'lease_expires_at': expires_at}, synchronize_session=False)
+    PortalRequestSlot.query.filter(
+        PortalRequestSlot.download_id.in_(download_ids)
+    ).update({'expires_at': expires_at}, synchronize_session=False)
+    db.session.commit()
+    return renewed
+
+def release_lease(worker_id, download_id):
+    """Drop this worker's lease once it has finished with a download, with any request slots it still holds"""
+    Download.query.filter(
+        Download.id == download_id,
+        Download.lease_owner == worker_id
+    ).update({'lease_owner': None, 'lease_expires_at': None}, synchronize_session=False)
+    PortalRequestSlot.query.filter_by(download_id=download_id).delete(synchronize_session=False)
+    db.session.commit()
+
+def reclaim_expired_leases(max_attempts):
+    """
+    Return downloads whose worker died (lease expired mid-run) to the queue
+    Downloads that already used up their attempts are marked failed instead
+    """
+    now = datetime.utcnow()
+    expired = [
+        Download.status == 'in_progress',
+        or_(Download.lease_expires_at.is_(None), Download.lease_expires_at < now)
+    ]
+    failed = Download.query.filter(*expired, Download.attempts >= max_attempts).update({
+        'status': 'failed',
+        'error_message': 'Download worker stopped responding too many times',
+        'lease_owner': None,
+        'lease_expires_at': None
+    }, synchronize_session=False)
+    requeued = Download.query.filter(*expired, Download.attempts < max_attempts).update({
+        'status': 'scheduled',
+        'lease_owner': None,
+        'lease_expires_at': None
+    }, synchronize_session=False)
+    db.session.commit()
+    if failed or requeued:
+        logging.warning("Reclaimed expired download leases: %s requeued, %s failed", requeued, failed)
+    return requeued + failed
+
+
+class DownloadWorkerPool:
+    """
+    Claims downloads from the database-backed queue and runs each one as a
+    coroutine on the fetch engine's event loop
+    At most max_workers downloads hold a lease at once, so anything beyond that stays 'scheduled'
+    """
+
+    def __init__(self, max_workers, poll_interval, lease_seconds, max_attempts):
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._active = set()
+        self._processed = 0
+
+    def _ensure_started(self):
+        # Threads are started lazily so gunicorn forks its workers before any exist
+        with self._lock:
+            if self._threads:
+                return
+            # The pid is only final after the fork
+            self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+            targets = [('download-dispatcher', self._dispatch), ('download-heartbeat', self._heartbeat)]
+            for name, target in targets:
+                thread = threading.Thread(target=target, name=name)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def start(self):
+        self._ensure_started()
+
+    def stop(self, timeout=None):
+        """
+        Stop claiming new downloads and wait for running ones to finish
+        Downloads still running after the timeout keep their lease until it
+        expires, after which another worker picks them up again
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for thread in self._threads:
+            if thread.name == 'download-dispatcher':
+                thread.join(timeout)
+        while deadline is None or time.monotonic() < deadline:
+            with self._lock:
+                if not self._active:
+                    break
+            time.sleep(0.5)
+        with self._lock:
+            return sorted(self._active)
+
+    def submit(self, download_id):
+        """Wake the dispatcher to pick up a newly queued download"""
+        self._ensure_started()
+        self._wakeup.set()
+        return True
+
+    def stats(self):
+        """Return a snapshot of the pool for inspection"""
+        queued = Download.query.filter_by(status='scheduled').count()
+        with self._lock:
+            return {
+                'worker_id': self.worker_id,
+                'max_workers': self.max_workers,
+                'queued': queued,
+                'active': len(self._active),
+                'active_downloads': sorted(self._active),
+                'processed': self._processed,
+            }
+
+    def _dispatch(self):
+        engine = get_fetch_engine()
+        with app.app_context():
+            while not self._stopping.is_set():
+                with self._lock:
+                    has_capacity = len(self._active) < self.max_workers
+                
+                download_id = None
+                if has_capacity:
+                    try:
+                        download_id = claim_next_download(self.worker_id, self.lease_seconds)
+                    except Exception:
+                        logging.exception("Failed to claim a download from the queue")
+                        db.session.rollback()
+                    finally:
+                        db.session.remove()
+                
+                if download_id is None:
+                    # Sleep until a download is queued, a slot frees up or the poll interval passes
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+                
+                with self._lock:
+                    self._active.add(download_id)
+                engine.submit(self._run(download_id))
+
+    async def _run(self, download_id):
+        try:
+            await process_download(download_id)
+        except Exception:
+            logging.exception("Unhandled error while processing download %s", download_id)
+        finally:
+            try:
+                await run_blocking(release_lease, self.worker_id, download_id)
+            except Exception:
+                logging.exception("Failed to release the lease on download %s", download_id)
+            with self._lock:
+                self._active.discard(download_id)
+                self._processed += 1
+            self._wakeup.set()
+
+    def _heartbeat(self):
+        next_prune = 0
+        with app.app_context():
+            while True:
+                time.sleep(max(self.lease_seconds / 3, 1))
+                with self._lock:
+                    active = list(self._active)
+                try:
+                    renew_leases(self.worker_id, active, self.lease_seconds)
+                    reclaim_expired_leases(self.max_attempts)
+                    reclaim_expired_slots()
+                    collect_unreferenced_files()
+                    if time.monotonic() >= next_prune:
+                        next_prune = time.monotonic() + PRUNE_INTERVAL_SECONDS
+                        prune_coverage()
+                except Exception:
+                    logging.exception("Download lease heartbeat failed")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+def get_worker_pool():
+    """Return the process-wide download worker pool, sized from the app config"""
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = DownloadWorkerPool(
+                max_workers=app.config['DOWNLOAD_MAX_WORKERS'],
+                poll_interval=app.config['DOWNLOAD_POLL_INTERVAL'],
+                lease_seconds=app.config['DOWNLOAD_LEASE_SECONDS'],
+                max_attempts=app.config['DOWNLOAD_MAX_ATTEMPTS']
+            )
+        return _worker_pool
 
 def schedule_download_job(download_id):
     """
-    Schedule a download job to run in the background
-    In a production application, you would use Celery or a similar task queue
+    Notify the worker pool that a download has been queued
+    The 'scheduled' Download row is the durable queue entry; any worker
+    process polling the queue will claim it
     """
-    # For simplicity, we're using a thread
-    # In production, use a proper task queue like Celery
-    thread = threading.Thread(target=process_download, args=(download_id,))
-    thread.daemon = True
-    thread.start()
-    return True
+    if not app.config['DOWNLOAD_EMBEDDED_WORKERS']:
+        # The standalone workers pick it up on their next poll
+        return True
+    return get_worker_pool().submit(download_id)
+
 
-def process_download(download_id):
-    """Process a scheduled download"""
-    # Get the download record
+def _update_download(download_id, **fields):
+    Download.query.filter_by(id=download_id).update(fields, synchronize_session=False)
+    db.session.commit()
+
+def _start_download(download_id):
+    """Mark a claimed download as in progress, returning False if it no longer exists"""
     download = Download.query.get(download_id)
     if not download:
-        return
+        return False
     
-    # Update status to in_progress
     download.status = 'in_progress'
     download.progress = 5  # Starting progress
     db.session.commit()
+    return True
+
+def _load_download_job(download_id):
+    """Collect everything the fetch needs so the event loop never touches the ORM"""
+    download = Download.query.get(download_id)
+    
+    # Get the credential
+    credential = Credential.query.get(download.credential_id)
+    if not credential:
+        raise Exception("Credential not found")
+    
+    # Get the portal
+    portal = Portal.query.get(download.portal_id)
+    if not portal:
+        raise Exception("Portal not found")
+    
+    return {
+        'download_id': download.id,
+        'user_id': download.user_id,
+        'created_at': download.created_at,
+        'portal_id': portal.id,
+        'portal_url': portal.url,
+        'username': credential.username,
+        'password': credential.get_password(),  # This is simplified for demo purposes
+        'rate_limit': portal.rate_limit,
+        'rate_limit_burst': portal.rate_limit_burst,
+        'max_concurrent_requests': portal.max_concurrent_requests,
+        'start_date': download.start_date,
+        'end_date': download.end_date,
+        'download_type': download.download_type,
+        'facility_username': download.facility_username,
+        'credential_id': credential.id,
+        'force_refresh': bool(download.force_refresh),
+    }
+
+def _load_chunk_checkpoints(download_id):
+    """Return the (start, end) of every chunk already fetched for a download"""
+    chunks = db.session.query(DownloadChunk.chunk_start, DownloadChunk.chunk_end).filter_by(download_id=download_id)
+    return {(chunk_start, chunk_end) for chunk_start, chunk_end in chunks}
+
+def _load_chunk_items(download_id, chunk_start, chunk_end):
+    """Return the items of a checkpointed chunk"""
+    items_json = db.session.query(DownloadChunk.items_json).filter_by(
+        download_id=download_id, chunk_start=chunk_start, chunk_end=chunk_end
+    ).scalar()
+    return json.loads(items_json)
+
+def _save_chunk_checkpoint(download_id, chunk_start, chunk_end, items):
+    exists = DownloadChunk.query.filter_by(
+        download_id=download_id, chunk_start=chunk_start, chunk_end=chunk_end
+    ).first()
+    if exists:
+        return
+    db.session.add(DownloadChunk(
+        download_id=download_id,
+        chunk_start=chunk_start,
+        chunk_end=chunk_end,
+        item_count=len(items),
+        items_json=json.dumps(items)
+    ))
+    db.session.commit()
+
+def _clear_chunk_checkpoints(download_id):
+    DownloadChunk.query.filter_by(download_id=download_id).delete(synchronize_session=False)
+    db.session.commit()
+
+async def process_download(download_id):
+    """Process a scheduled download on the fetch engine's event loop"""
+    # Get the download record and update status to in_progress
+    if not await run_blocking(_start_download, download_id):
+        return
     
+    progress = progress_reporter(download_id)
+    writer = None
     try:
-        # Get the credential
-        credential = Credential.query.get(download.credential_id)
-        if not credential:
-            raise Exception("Credential not found")
-        
-        # Get the portal
-        portal = Portal.query.get(download.portal_id)
-        if not portal:
-            raise Exception("Portal not found")
+        job = await run_blocking(_load_download_job, download_id)
+        progress.start(job['user_id'], job['download_type'], job['facility_username'], job['created_at'], progress=5)
         
         # Simulate steps in the download process
         # In a real application, this would be calling the actual portal API
         
         # Step 1: Authentication (10% progress)
-        time.sleep(2)  # Simulate API call delay
-        download.progress = 10
-        db.session.commit()
+        await asyncio.sleep(2)  # Simulate API call delay
+        progress.report(10)
         
         # Step 2: Validate parameters (20% progress)
-        time.sleep(1)  # Simulate processing
-        download.progress = 20
-        db.session.commit()
+        await asyncio.sleep(1)  # Simulate processing
+        progress.report(20)
         
-        # Step 3: Fetch data (20-80% progress)
-        # Simulate fetching data with incremental progress updates
-        credential_password = credential.get_password()  # This is simplified for demo purposes
+        # Step 3: Fetch data (20-80% progress, advanced as each chunk completes)
+        # Items are streamed to the result file in date order as chunks arrive
+        header = portal_document_header(
+            job['portal_url'], job['download_type'], job['facility_username'], job['start_date'], job['end_date']
+        )
+        writer = await run_blocking(open_download_file, header)
         
-        # Fetch the actual data from the portal
-        json_data = fetch_json_from_portal(
-            portal.url, 
-            credential.username, 
-            credential_password,
-            download.start_date, 
-            download.end_date,
-            download.download_type,
-            download.facility_username
+        # Days that earlier downloads already fetched and that have settled are read back from the
+        # coverage index; only the rest of the range is fetched from the portal
+        coverage = (job['credential_id'], job['facility_username'], job['download_type'])
+        covered = set()
+        if not job['force_refresh']:
+            covered = await run_blocking(covered_days, *coverage, job['start_date'], job['end_date'])
+        chunks, covered_chunks = plan_delta_chunks(
+            job['start_date'], job['end_date'], app.config['DOWNLOAD_CHUNK_DAYS'], covered
         )
         
-        # Step 4: Process and save data (80-90% progress)
-        download.progress = 80
-        db.session.commit()
+        # Chunks checkpointed by an earlier, failed attempt are not fetched again
+        checkpoints = await run_blocking(_load_chunk_checkpoints, download_id)
         
-        # Create a directory for downloads if it doesn't exist
-        downloads_dir = os.path.join(os.getcwd(), 'static', 'downloads')
-        os.makedirs(downloads_dir, exist_ok=True)
+        async def load_checkpoint(chunk_start, chunk_end):
+            if (chunk_start, chunk_end) in covered_chunks:
+                return await run_blocking(load_covered_items, *coverage, chunk_start, chunk_end)
+            return await run_blocking(_load_chunk_items, download_id, chunk_start, chunk_end)
         
-        # Save the downloaded data to a file
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{download.download_type}_{download.portal_id}_{timestamp}.json"
-        filepath = os.path.join(downloads_dir, filename)
+        async def on_chunk(chunk_start, chunk_end, items):
+            await run_blocking(_save_chunk_checkpoint, download_id, chunk_start, chunk_end, items)
+            await run_blocking(record_coverage, job['portal_id'], *coverage, chunk_start, chunk_end, items)
         
-        with open(filepath, 'w') as f:
-            json.dump(json_data, f, indent=2)
+        async def on_items(items):
+            await run_blocking(writer.write_items, items)
         
-        download.progress = 90
-        download.file_path = f"/static/downloads/{filename}"
-        db.session.commit()
+        async def on_progress(fraction):
+            progress.report(20 + int(60 * fraction))
+        
+        def request_slot():
+            return portal_request_slot(
+                job['portal_id'], download_id, job['rate_limit'], job['rate_limit_burst'], job['max_concurrent_requests']
+            )
+        
+        # Fetch the actual data from the portal
+        await fetch_json_from_portal(
+            job['portal_url'],
+            job['username'],
+            job['password'],
+            job['start_date'],
+            job['end_date'],
+            job['download_type'],
+            job['facility_username'],
+            on_progress=on_progress,
+            request_slot=request_slot,
+            chunks=chunks,
+            checkpoints=checkpoints | covered_chunks,
+            load_checkpoint=load_checkpoint,
+            on_chunk=on_chunk,
+            on_items=on_items
+        )
+        
+        # Step 4: Process and save data (80-90% progress)
+        progress.report(80)
+        # Identical content already in the store is shared rather than stored again
+        file_path = await run_blocking(writer.close)
+        if await run_blocking(record_download_file, download_id, file_path, writer):
+            await run_blocking(writer.publish)
+        else:
+            await run_blocking(writer.abort)
+        writer = None
+        await run_blocking(_clear_chunk_checkpoints, download_id)
+        progress.report(90)
         
         # Step 5: Final processing and cleanup (100% progress)
-        time.sleep(1)  # Simulate final processing
-        download.status = 'completed'
-        download.progress = 100
-        db.session.commit()
+        await asyncio.sleep(1)  # Simulate final processing
+        await run_blocking(progress.close)
+        await run_blocking(_update_download, download_id, status='completed', progress=100)
+        # Identical requests in the next few minutes are answered from this result
+        try:
+            await run_blocking(remember_download_result, download_id)
+        except Exception:
+            logging.exception("Failed to cache the result of download %s", download_id)
         
     except Exception as e:
         # Handle any errors
-        download.status = 'failed'
-        download.error_message = str(e)
-        db.session.commit()
+        try:
+            await run_blocking(progress.close)
+        except Exception:
+            # The stale entry stops being served after DOWNLOAD_LEASE_SECONDS; the failure is still recorded
+            logging.exception("Failed to unpublish the progress of download %s", download_id)
+        if writer is not None:
+            await run_blocking(writer.abort)
+        await run_blocking(_update_download, download_id, status='failed', error_message=str(e))
 
-def fetch_json_from_portal(portal_url, username, password, start_date, end_date, download_type='submission', facility_username=None):
+def split_date_range(start_date, end_date, chunk_days):
+    """Split an inclusive date range into consecutive (start, end) chunks of at most chunk_days days"""
+    chunks = []
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + timedelta(days=1)
+    return chunks
+
+def plan_delta_chunks(start_date, end_date, chunk_days, covered):
     """
-    Fetch JSON data from an external portal
-    This is a placeholder for the actual implementation
+    Split an inclusive date range around the days in covered: runs of covered days and runs of
+    missing days are each split into chunks of at most chunk_days days
+    Returns the chunks in date order and the set of those made up of covered days
     """
-    # Simulate the API call
-    # In a real application, this would use requests to call the actual API
-    
-    # Simulate progress
-    for progress in range(30, 80, 10):
-        time.sleep(2)  # Simulate time for data retrieval
-        
-        # Get the download that's in progress and update its progress
-        in_progress_downloads = Download.query.filter_by(status='in_progress').all()
-        for download in in_progress_downloads:
-            download.progress = progress
-            db.session.commit()
-    
-    # Generate mock data based on the parameters
-    # In a real application, this would be the actual data from the API
-    mock_data = {
+    chunks = []
+    covered_chunks = set()
+    run_start = start_date
+    while run_start <= end_date:
+        is_covered = run_start in covered
+        run_end = run_start
+        while run_end < end_date and (run_end + timedelta(days=1) in covered) == is_covered:
+            run_end += timedelta(days=1)
+        run_chunks = split_date_range(run_start, run_end, chunk_days)
+        chunks.extend(run_chunks)
+        if is_covered:
+            covered_chunks.update(run_chunks)
+        run_start = run_end + timedelta(days=1)
+    return chunks, covered_chunks
+
+def retry_delay(attempt):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)"""
+    ceiling = min(app.config['DOWNLOAD_RETRY_MAX_DELAY'], app.config['DOWNLOAD_RETRY_BASE_DELAY'] * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+def portal_document_header(portal_url, download_type, facility_username, start_date, end_date):
+    """The fields of a downloaded JSON document that come before its items"""
+    return {
         "portal_url": portal_url,
         "download_type": download_type,
         "facility_username": facility_username,
@@ -131,18 +527,121 @@ def fetch_json_from_portal(portal_url, username, password, start_date, end_date,
             "start_date": start_date.isoformat(),
             "end_date": end_date.isoformat()
         },
-        "timestamp": datetime.now().isoformat(),
-        "items": []
+        "timestamp": datetime.now().isoformat()
     }
+
+async def fetch_json_from_portal(portal_url, username, password, start_date, end_date, download_type='submission', facility_username=None, on_progress=None, request_slot=None, chunks=None, checkpoints=None, load_checkpoint=None, on_chunk=None, on_items=None):
+    """
+    Fetch JSON data from an external portal
+    The date range is split into chunks that are fetched concurrently, within the
+    portal's chunk limit, and passed on in date order
+    chunks, if given, is the range already split into (chunk_start, chunk_end) pairs in date order
+    on_progress is awaited with the fraction of chunks completed after each chunk
+    request_slot returns an async context manager entered around every portal request
+    checkpoints holds the (chunk_start, chunk_end) of chunks already fetched; their items are
+    read back with load_checkpoint(chunk_start, chunk_end) instead of being fetched again
+    on_chunk is awaited with (chunk_start, chunk_end, items) after each newly fetched chunk
+    on_items is awaited with each chunk's items in date order; when given, items are not
+    kept and the returned document has no "items", so memory doesn't grow with the download
+    """
+    if chunks is None:
+        chunks = split_date_range(start_date, end_date, app.config['DOWNLOAD_CHUNK_DAYS'])
+    limit = get_fetch_engine().portal_semaphore(portal_url, app.config['DOWNLOAD_CHUNK_CONCURRENCY'])
+    checkpoints = checkpoints or set()
+    completed = sum(1 for chunk in chunks if chunk in checkpoints)
+    
+    # Chunks finish out of order; at most `window` chunks past the next one to be passed on
+    # may be fetched, which bounds how many are held in memory waiting for their turn
+    window = 2 * app.config['DOWNLOAD_CHUNK_CONCURRENCY']
+    finished = {}
+    next_index = 0
+    turn = asyncio.Condition()
+    all_items = []
+    
+    async def fetch_chunk(chunk_start, chunk_end):
+        nonlocal completed
+        if (chunk_start, chunk_end) in checkpoints:
+            return await load_checkpoint(chunk_start, chunk_end)
+        
+        attempt = 0
+        while True:
+            try:
+                async with limit, (request_slot() if request_slot else nullcontext()):
+                    items = await fetch_chunk_from_portal(
+                        portal_url, username, password, chunk_start, chunk_end, download_type, facility_username
+                    )
+                break
+            except Exception as e:
+                if not is_transient_error(e) or attempt >= app.config['DOWNLOAD_CHUNK_RETRIES']:
+                    raise
+                delay = retry_delay(attempt)
+                logging.warning("Chunk %s..%s failed (%s), retrying in %.1fs", chunk_start, chunk_end, e, delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+        
+        if on_chunk:
+            await on_chunk(chunk_start, chunk_end, items)
+        completed += 1
+        if on_progress:
+            await on_progress(completed / len(chunks))
+        return items
     
-    # Generate some mock items
+    async def run_chunk(index, chunk_start, chunk_end):
+        nonlocal next_index
+        async with turn:
+            await turn.wait_for(lambda: index < next_index + window)
+        items = await fetch_chunk(chunk_start, chunk_end)
+        
+        async with turn:
+            finished[index] = items
+            # Pass on every chunk whose predecessors are all done, in date order
+            while next_index in finished:
+                ready = finished.pop(next_index)
+                if on_items:
+                    await on_items(ready)
+                else:
+                    all_items.extend(ready)
+                next_index += 1
+            turn.notify_all()
+    
+    tasks = [
+        asyncio.ensure_future(run_chunk(index, chunk_start, chunk_end))
+        for index, (chunk_start, chunk_end) in enumerate(chunks)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the remaining chunks; the ones already fetched are checkpointed for the retry
+        for task in tasks:
+            task.cancel()
+        raise
+    
+    document = portal_document_header(portal_url, download_type, facility_username, start_date, end_date)
+    if not on_items:
+        document["items"] = all_items
+    return document
+
+async def fetch_chunk_from_portal(portal_url, username, password, start_date, end_date, download_type='submission', facility_username=None):
+    """
+    Fetch the items for one chunk of the date range from an external portal
+    This is a placeholder for the actual implementation
+    """
+    # Simulate the API call
+    # In a real application, this would call the actual API over the portal's pooled session:
+    #   payload = await get_fetch_engine().get_json(portal_url, f"api/{download_type}",
+    #                                               params=..., auth=aiohttp.BasicAuth(username, password))
+    await asyncio.sleep(random.uniform(1, 2))  # Simulate time for data retrieval
+    
+    # Generate mock items based on the parameters, one per day
+    # In a real application, this would be the actual data from the API
+    items = []
     date_range = (end_date - start_date).days + 1
-    for i in range(min(date_range, 10)):  # Generate up to 10 items
+    for i in range(date_range):
         current_date = start_date + timedelta(days=i)
         
         if download_type == 'submission':
             # Generate mock submission data
-            mock_data["items"].append({
+            items.append({
                 "id": f"SUB{random.randint(1000, 9999)}",
                 "date": current_date.isoformat(),
                 "status": random.choice(["Submitted", "Processed", "Pending"]),
@@ -152,7 +651,7 @@ def fetch_json_from_portal(portal_url, username, password, start_date, end_date,
             })
         else:  # remittance
             # Generate mock remittance data
-            mock_data["items"].append({
+            items.append({
                 "id": f"REM{random.randint(1000, 9999)}",
                 "date": current_date.isoformat(),
                 "status": random.choice(["Paid", "Pending", "Rejected"]),
@@ -162,4 +661,4 @@ def fetch_json_from_portal(portal_url, username, password, start_date, end_date,
                 "transaction_id": f"TX{random.randint(10000, 99999)}"
             })
     
-    return mock_data
+    return items
@@ -0,0 +1,145 @@
+"""
+Asyncio engine for portal fetches
+
+A single event loop per process runs every in-flight download. Each portal
+gets its own keep-alive HTTP session, so repeated fetches reuse TCP/TLS
+connections instead of opening a new one per request, and a waiting fetch
+costs a coroutine rather than a thread.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+
+from app import app, db
+
+
+def _portal_key(portal_url):
+    parts = urlsplit(portal_url)
+    return (parts.scheme, parts.netloc)
+
+
+def is_transient_error(exc):
+    """True for failures worth retrying: timeouts, dropped connections, throttling and server errors"""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+
+class FetchEngine:
+    """Owns the event loop thread and the pooled HTTP sessions, one per portal"""
+
+    def __init__(self, connections_per_portal, connect_timeout, read_timeout, keepalive_timeout):
+        self.connections_per_portal = connections_per_portal
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self._loop = None
+        self._thread = None
+        self._sessions = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # The loop is started lazily so gunicorn forks its workers before it exists
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name="fetch-engine")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the engine loop and return a concurrent.futures.Future"""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def stop(self, timeout=10):
+        """Close the portal sessions and stop the event loop"""
+        if self._loop is None:
+            return
+        self.submit(self._close_sessions()).result(timeout)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+
+    def portal_semaphore(self, portal_url, limit):
+        """Return the semaphore capping concurrent chunk fetches against a portal"""
+        key = _portal_key(portal_url)
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = self._semaphores[key] = asyncio.Semaphore(limit)
+        return semaphore
+
+    def session_for(self, portal_url):
+        """Return the keep-alive session for a portal, creating it on first use"""
+        key = _portal_key(portal_url)
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connections_per_portal,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._sessions[key] = session
+        return session
+
+    async def get_json(self, portal_url, path='', params=None, auth=None):
+        """GET a JSON document from a portal over its pooled session"""
+        session = self.session_for(portal_url)
+        async with session.get(urljoin(portal_url, path), params=params, auth=auth) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def _close_sessions(self):
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            await session.close()
+
+
+_fetch_engine = None
+_fetch_engine_lock = threading.Lock()
+
+def get_fetch_engine():
+    """Return the process-wide fetch engine, configured from the app config"""
+    global _fetch_engine
+    with _fetch_engine_lock:
+        if _fetch_engine is None:
+            _fetch_engine = FetchEngine(
+                connections_per_portal=app.config['PORTAL_CONNECTIONS_PER_PORTAL'],
+                connect_timeout=app.config['PORTAL_CONNECT_TIMEOUT'],
+                read_timeout=app.config['PORTAL_READ_TIMEOUT'],
+                keepalive_timeout=app.config['PORTAL_KEEPALIVE_TIMEOUT']
+            )
+        return _fetch_engine
+
+
+_blocking_executor = None
+_blocking_executor_lock = threading.Lock()
+
+def _call_in_app_context(fn, *args, **kwargs):
+    with app.app_context():
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            db.session.remove()
+
+def run_blocking(fn, *args, **kwargs):
+    """
+    Run a blocking call (database queries, file writes) from the event loop
+    on a small dedicated thread pool, inside an app context
+    """
+    global _blocking_executor
+    with _blocking_executor_lock:
+        if _blocking_executor is None:
+            _blocking_executor = ThreadPoolExecutor(
+                max_workers=app.config['DOWNLOAD_BLOCKING_THREADS'],
+                thread_name_prefix='download-blocking'
+            )
+    call = functools.partial(_call_in_app_context, fn, *args, **kwargs)
+    return asyncio.get_running_loop().run_in_executor(_blocking_executor, call)
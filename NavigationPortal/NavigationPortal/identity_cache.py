@@ -0,0 +1,124 @@
+"""
+Process-local cache of who is signed in and what they may do
+
+login_required and admin_required look the session's user up here instead
+of querying the user table on every request. Entries are kept for the
+IDENTITY_CACHE_SIZE most recently seen users and rechecked against the
+database after IDENTITY_CACHE_TTL seconds.
+
+Role changes and deletions also bump the 'identities' CacheVersion row in
+the same transaction. Each process reads that one counter at most every
+IDENTITY_CACHE_VERSION_INTERVAL seconds, whatever its request rate, and
+drops all its entries when it moves, so a demotion or deletion applies in
+every process within that interval while most requests still authorize
+without touching the database. Role
+changes also bump User.account_version; the session remembers the account
+version it was issued for and is refreshed (or ended, for a deleted user)
+when it differs.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from app import app, db
+from models import CacheVersion, User
+
+Identity = namedtuple('Identity', ['user_id', 'is_admin', 'account_version'])
+
+CACHE_NAME = 'identities'
+
+
+class IdentityCache:
+    """LRU of user id -> Identity, or None for users that no longer exist"""
+
+    def __init__(self, max_entries, ttl, version_interval):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_interval = version_interval
+        self._entries = OrderedDict()
+        self._version = None
+        self._version_checked_at = None
+        # Bumped whenever the entries are dropped, so a lookup that raced a drop isn't cached
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _check_version(self, now):
+        """Drop every entry if the shared counter moved; reads it at most once per interval"""
+        with self._lock:
+            if self._version_checked_at is not None and now - self._version_checked_at < self.version_interval:
+                return
+            self._version_checked_at = now
+
+        version = db.session.query(CacheVersion.version).filter_by(name=CACHE_NAME).scalar() or 0
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+                self._generation += 1
+
+    def get(self, user_id):
+        now = time.monotonic()
+        self._check_version(now)
+        with self._lock:
+            generation = self._generation
+            entry = self._entries.get(user_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(user_id)
+                return entry[0]
+
+        row = db.session.query(User.is_admin, User.account_version).filter(User.id == user_id).first()
+        identity = None
+        if row is not None:
+            identity = Identity(user_id, bool(row.is_admin), row.account_version or 0)
+
+        with self._lock:
+            if generation != self._generation:
+                return identity
+            self._entries[user_id] = (identity, now)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return identity
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+_identity_cache = None
+_identity_cache_lock = threading.Lock()
+
+def _get_identity_cache():
+    global _identity_cache
+    with _identity_cache_lock:
+        if _identity_cache is None:
+            _identity_cache = IdentityCache(
+                max_entries=app.config['IDENTITY_CACHE_SIZE'],
+                ttl=app.config['IDENTITY_CACHE_TTL'],
+                version_interval=app.config['IDENTITY_CACHE_VERSION_INTERVAL']
+            )
+        return _identity_cache
+
+def get_identity(user_id):
+    """Return the Identity of a user, or None if the user has been deleted"""
+    return _get_identity_cache().get(user_id)
+
+def publish_identity_change():
+    """
+    Make every process drop its cached identities, as part of the current transaction
+    Call before committing a role change or deletion
+    """
+    bumped = CacheVersion.query.filter_by(name=CACHE_NAME).update(
+        {'version': CacheVersion.version + 1}, synchronize_session=False
+    )
+    if not bumped:
+        db.session.add(CacheVersion(name=CACHE_NAME, version=1))
+
+def bump_account_version(user):
+    """Mark a user's role as changed; commit, then call invalidate_identity"""
+    user.account_version = (user.account_version or 0) + 1
+    publish_identity_change()
+
+def invalidate_identity(user_id):
+    """Drop this process's cached identity for a user, after the change was committed"""
+    _get_identity_cache().invalidate(user_id)
@@ -0,0 +1,216 @@
+"""
+Versioned schema migrations
+
+Each migration runs once, in its own transaction, and is recorded in the
+schema_version table. Run them at deploy time, before the new code starts:
+
+    flask --app main init-db        # apply pending migrations
+    flask --app main init-db --drop # drop everything and rebuild an empty schema
+    python -m migrations            # same as init-db, without the flask CLI
+    python -m migrations --status   # list pending migrations without applying them
+
+Databases created by the old import-time db.create_all() are brought up to
+date by the same steps, so migrations only add what is missing.
+"""
+import argparse
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select
+
+from app import app, configure_app, db
+import models  # noqa: F401 (registers the tables on db.metadata)
+
+_version_metadata = MetaData()
+schema_version = Table(
+    'schema_version', _version_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False, default=datetime.utcnow)
+)
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """Register a function taking a connection as schema migration number version"""
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return fn
+    return register
+
+
+def _add_missing_columns(connection, table_name, column_names):
+    table = db.metadata.tables[table_name]
+    existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+    for name in column_names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        column_type = column.type.compile(dialect=connection.dialect)
+        # Quoted, since e.g. "user" is a reserved word on Postgres
+        preparer = connection.dialect.identifier_preparer
+        connection.exec_driver_sql(
+            f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column_type}'
+        )
+        if column.default is not None and column.default.is_scalar:
+            connection.execute(table.update().values({name: column.default.arg}))
+
+def _create_indexes(connection, table_name, index_names):
+    for index in db.metadata.tables[table_name].indexes:
+        if index.name in index_names:
+            index.create(connection, checkfirst=True)
+
+
+@migration(1, 'Create tables')
+def create_tables(connection):
+    db.metadata.create_all(connection, checkfirst=True)
+
+@migration(2, 'Add portal limits and download queue lease columns')
+def add_limit_and_lease_columns(connection):
+    _add_missing_columns(connection, 'portal', ['rate_limit', 'rate_limit_burst', 'max_concurrent_requests', 'updated_at'])
+    _add_missing_columns(connection, 'download', ['lease_owner', 'lease_expires_at', 'attempts'])
+    portal = db.metadata.tables['portal']
+    connection.execute(portal.update().where(portal.c.updated_at.is_(None)).values(updated_at=portal.c.created_at))
+
+@migration(3, 'Index the columns the history pages and download queue filter and sort on')
+def add_query_indexes(connection):
+    _create_indexes(connection, 'download', {'ix_download_user_created', 'ix_download_status_updated', 'ix_download_portal_status'})
+    _create_indexes(connection, 'credential', {'ix_credential_user_portal'})
+    # Fails if two portals already share a name; rename one and run again
+    _create_indexes(connection, 'portal', {'ix_portal_name'})
+
+@migration(4, 'Add cache version counters')
+def add_cache_versions(connection):
+    cache_version = db.metadata.tables['cache_version']
+    cache_version.create(connection, checkfirst=True)
+    if connection.execute(select(cache_version.c.name).where(cache_version.c.name == 'portals')).first() is None:
+        connection.execute(cache_version.insert().values(name='portals', version=0))
+
+@migration(5, 'Add user account versions')
+def add_account_versions(connection):
+    _add_missing_columns(connection, 'user', ['account_version'])
+
+@migration(6, 'Add download file storage stats')
+def add_download_storage_stats(connection):
+    _add_missing_columns(connection, 'download', ['compression', 'file_size', 'content_size', 'bytes_read'])
+
+@migration(7, 'Add the content-addressed file store')
+def add_stored_files(connection):
+    db.metadata.tables['stored_file'].create(connection, checkfirst=True)
+
+@migration(8, 'Add the download result cache')
+def add_download_result_cache(connection):
+    _add_missing_columns(connection, 'portal', ['result_cache_ttl'])
+    db.metadata.tables['download_result_cache'].create(connection, checkfirst=True)
+
+@migration(9, 'Add the per-day coverage index for delta downloads')
+def add_coverage_days(connection):
+    _add_missing_columns(connection, 'download', ['force_refresh'])
+    db.metadata.tables['coverage_day'].create(connection, checkfirst=True)
+
+@migration(10, 'Move download result files out of the static folder')
+def move_download_files(connection):
+    # Files used to live in static/downloads, where Flask served them to anyone, and were
+    # recorded by their public path; they are now recorded by name alone
+    for table_name in ('download', 'stored_file'):
+        table = db.metadata.tables[table_name]
+        rows = connection.execute(select(table.c.file_path).where(table.c.file_path.like('/static/downloads/%'))).scalars().all()
+        for file_path in set(rows):
+            connection.execute(
+                table.update().where(table.c.file_path == file_path).values(file_path=os.path.basename(file_path))
+            )
+    
+    old_directory = os.path.join(os.getcwd(), 'static', 'downloads')
+    new_directory = app.config['DOWNLOAD_STORAGE_DIR']
+    if os.path.isdir(old_directory):
+        os.makedirs(new_directory, exist_ok=True)
+        for name in os.listdir(old_directory):
+            path = os.path.join(old_directory, name)
+            if os.path.isfile(path):
+                shutil.move(path, os.path.join(new_directory, name))
+
+@migration(11, 'Hold portal request slots per download instead of counting them')
+def add_portal_request_slots(connection):
+    db.metadata.tables['portal_request_slot'].create(connection, checkfirst=True)
+    # The in-flight counter leaked whenever a worker died mid-request; slots replace it
+    existing = {column['name'] for column in inspect(connection).get_columns('portal_throttle')}
+    if 'in_flight' in existing:
+        connection.exec_driver_sql('ALTER TABLE portal_throttle DROP COLUMN in_flight')
+
+@migration(12, 'Index coverage days by when they were fetched, for pruning')
+def add_coverage_fetched_index(connection):
+    _create_indexes(connection, 'coverage_day', {'ix_coverage_day_fetched_at'})
+
+
+def applied_versions(connection):
+    _version_metadata.create_all(connection, checkfirst=True)
+    return set(connection.execute(select(schema_version.c.version)).scalars())
+
+def pending_migrations():
+    """Return the (version, description) of every migration not yet applied"""
+    with db.engine.begin() as connection:
+        applied = applied_versions(connection)
+    return [(version, description) for version, description, _ in MIGRATIONS if version not in applied]
+
+def upgrade():
+    """Apply all pending migrations in order and return the versions applied"""
+    applied_now = []
+    for version, description, fn in MIGRATIONS:
+        with db.engine.begin() as connection:
+            # Checked inside the transaction; a concurrent run trips over the primary key instead
+            if version in applied_versions(connection):
+                continue
+            logging.info("Applying migration %s: %s", version, description)
+            fn(connection)
+            connection.execute(schema_version.insert().values(
+                version=version, description=description, applied_at=datetime.utcnow()
+            ))
+        applied_now.append(version)
+    return applied_now
+
+
+def drop_all():
+    """Drop every table, including the migration history"""
+    db.drop_all()
+    with db.engine.begin() as connection:
+        _version_metadata.drop_all(connection, checkfirst=True)
+
+
+@click.command('init-db')
+@click.option('--drop', is_flag=True, help='Drop all tables first. Deletes all data.')
+@with_appcontext
+def init_db_command(drop):
+    """Create the database schema or bring it up to date"""
+    if drop:
+        drop_all()
+        click.echo('Dropped all tables')
+    applied = upgrade()
+    click.echo(f'Applied migrations {applied}' if applied else 'Database schema is up to date')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply database schema migrations')
+    parser.add_argument('--status', action='store_true', help='list pending migrations without applying them')
+    args = parser.parse_args()
+
+    configure_app()
+    with app.app_context():
+        if args.status:
+            pending = pending_migrations()
+            for version, description in pending:
+                print(f'pending  {version:>4}  {description}')
+            if not pending:
+                print('Database schema is up to date')
+            return
+
+        applied = upgrade()
+        print(f'Applied migrations {applied}' if applied else 'Database schema is up to date')
+
+
+if __name__ == "__main__":
+    main()
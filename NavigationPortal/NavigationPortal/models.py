@@ -1,6 +1,6 @@
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
 from app import db
+from password_hashing import hash_password, verify_password
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -8,6 +8,8 @@ class User(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+    # Bumped whenever the account's role changes, so cached identities and sessions are refreshed
+    account_version = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -15,31 +17,78 @@ class User(db.Model):
     downloads = db.relationship('Download', backref='user', lazy=True, cascade="all, delete-orphan")
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
 
     def __repr__(self):
         return f'<User {self.username}>'
 
 
 class Portal(db.Model):
+    __table_args__ = (db.Index('ix_portal_name', 'name', unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     url = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text, nullable=True)
+    # Limits enforced across all download workers; None means unlimited
+    rate_limit = db.Column(db.Float, nullable=True)  # Requests per second
+    rate_limit_burst = db.Column(db.Integer, nullable=True)  # Token bucket size
+    max_concurrent_requests = db.Column(db.Integer, nullable=True)
+    # Seconds a finished download is reused for identical requests; None means DOWNLOAD_RESULT_CACHE_TTL, 0 disables
+    result_cache_ttl = db.Column(db.Integer, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
     credentials = db.relationship('Credential', backref='portal', lazy=True, cascade="all, delete-orphan")
     downloads = db.relationship('Download', backref='portal', lazy=True, cascade="all, delete-orphan")
+    throttle = db.relationship('PortalThrottle', uselist=False, cascade="all, delete-orphan")
 
     def __repr__(self):
         return f'<Portal {self.name}>'
 
 
+class PortalThrottle(db.Model):
+    """Shared token bucket of one portal"""
+    portal_id = db.Column(db.Integer, db.ForeignKey('portal.id'), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False, default=0)
+    refilled_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped on every write so concurrent workers can update the row with compare-and-set
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<PortalThrottle for portal {self.portal_id} ({self.tokens:.1f} tokens)>'
+
+
+class PortalRequestSlot(db.Model):
+    """
+    One request in flight to a portal with a concurrency cap, held by a download
+    Slots expire with the download's lease, so those of a worker that died are reclaimed
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    portal_id = db.Column(db.Integer, db.ForeignKey('portal.id'), nullable=False)
+    download_id = db.Column(db.Integer, db.ForeignKey('download.id', ondelete='CASCADE'), nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<PortalRequestSlot {self.id} of portal {self.portal_id} for download {self.download_id}>'
+
+
+class CacheVersion(db.Model):
+    """Version counter of a cached dataset; writers bump it so every process drops its copy"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<CacheVersion {self.name} v{self.version}>'
+
+
 class Credential(db.Model):
+    __table_args__ = (db.Index('ix_credential_user_portal', 'user_id', 'portal_id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     portal_id = db.Column(db.Integer, db.ForeignKey('portal.id'), nullable=False)
@@ -48,8 +97,10 @@ class Credential(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    coverage_days = db.relationship('CoverageDay', backref='credential', lazy=True, cascade="all, delete-orphan")
+
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def get_password(self):
         # In a real application, this should be more secure
@@ -72,12 +123,106 @@ class Download(db.Model):
     status = db.Column(db.String(20), default='scheduled')  # scheduled, in_progress, completed, failed
     progress = db.Column(db.Integer, default=0)  # Progress percentage (0-100)
     file_path = db.Column(db.String(255), nullable=True)
+    # How the result file is stored: compression ('none', 'gzip', 'zstd'), bytes on disk and
+    # bytes of JSON inside, plus the bytes read from disk to serve it so far
+    compression = db.Column(db.String(10), nullable=True)
+    file_size = db.Column(db.BigInteger, nullable=True)
+    content_size = db.Column(db.BigInteger, nullable=True)
+    bytes_read = db.Column(db.BigInteger, default=0)
     error_message = db.Column(db.Text, nullable=True)
+    # Fetch every day from the portal instead of reusing days already covered
+    force_refresh = db.Column(db.Boolean, default=False)
+    # Queue lease: the worker currently processing the job and when its claim lapses
+    lease_owner = db.Column(db.String(100), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    attempts = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationship
     credential = db.relationship('Credential', backref='downloads')
+    chunks = db.relationship('DownloadChunk', backref='download', lazy=True, cascade="all, delete-orphan")
+    result_cache_entries = db.relationship('DownloadResultCache', backref='download', lazy=True, cascade="all, delete-orphan")
+    request_slots = db.relationship('PortalRequestSlot', lazy=True, cascade="all, delete-orphan")
 
     def __repr__(self):
         return f'<Download for portal {self.portal_id} ({self.status})>'
+
+
+# History pages list a user's downloads newest first
+db.Index('ix_download_user_created', Download.user_id, Download.created_at.desc())
+# The queue and its heartbeat look up downloads by state
+db.Index('ix_download_status_updated', Download.status, Download.updated_at)
+# Per-portal concurrency checks count a portal's running downloads
+db.Index('ix_download_portal_status', Download.portal_id, Download.status)
+# ... and the request slots its downloads hold
+db.Index('ix_portal_request_slot_portal_expires', PortalRequestSlot.portal_id, PortalRequestSlot.expires_at)
+
+
+class StoredFile(db.Model):
+    """
+    A result file in the content-addressed store, shared by every download with the same content
+    ref_count is the number of downloads pointing at it; files no longer referenced are collected
+    """
+    file_path = db.Column(db.String(255), primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False)  # SHA-256 of the canonical payload
+    compression = db.Column(db.String(10), nullable=False)
+    file_size = db.Column(db.BigInteger, nullable=False)
+    content_size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StoredFile {self.file_path} ({self.ref_count} refs)>'
+
+
+class DownloadResultCache(db.Model):
+    """
+    The latest finished download for one set of request parameters, reused by identical requests
+    Entries are dropped with their download and evicted least recently used first
+    """
+    cache_key = db.Column(db.String(64), primary_key=True)  # SHA-256 of the request parameters
+    portal_id = db.Column(db.Integer, nullable=False)
+    download_id = db.Column(db.Integer, db.ForeignKey('download.id', ondelete='CASCADE'), nullable=False)
+    stored_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<DownloadResultCache {self.cache_key[:12]} -> download {self.download_id}>'
+
+
+class CoverageDay(db.Model):
+    """
+    One day of a facility's data as last fetched from a portal, so later downloads of an
+    overlapping range fetch only the days they are missing
+    """
+    __table_args__ = (db.UniqueConstraint('credential_id', 'facility_username', 'download_type', 'day'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    portal_id = db.Column(db.Integer, db.ForeignKey('portal.id'), nullable=False)
+    credential_id = db.Column(db.Integer, db.ForeignKey('credential.id'), nullable=False)
+    facility_username = db.Column(db.String(100), nullable=False)  # '' when the download named none
+    download_type = db.Column(db.String(20), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    item_count = db.Column(db.Integer, default=0)
+    items_json = db.Column(db.Text, nullable=False)  # The day's items as a JSON array
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<CoverageDay {self.day} of {self.download_type} for {self.facility_username!r}>'
+
+
+class DownloadChunk(db.Model):
+    """Checkpoint of one fetched date-range chunk, so a failed download can resume"""
+    __table_args__ = (db.UniqueConstraint('download_id', 'chunk_start', 'chunk_end'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    download_id = db.Column(db.Integer, db.ForeignKey('download.id'), nullable=False)
+    chunk_start = db.Column(db.Date, nullable=False)
+    chunk_end = db.Column(db.Date, nullable=False)
+    item_count = db.Column(db.Integer, default=0)
+    items_json = db.Column(db.Text, nullable=False)  # The chunk's items as a JSON array
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<DownloadChunk {self.chunk_start}..{self.chunk_end} of download {self.download_id}>'
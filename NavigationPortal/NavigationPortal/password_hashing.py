@@ -0,0 +1,85 @@
+"""
+Password hashing off the request threads
+
+PBKDF2 is deliberately slow and CPU-bound, so hashes are computed in a small
+pool of worker processes instead of the gunicorn threads that also serve
+status polls. At most PASSWORD_HASH_MAX_PENDING hashes may be running or
+queued per process; past that, requests fail at once with 429 Too Many
+Requests rather than piling up behind a login storm.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from app import app
+
+
+class PasswordHashingBusy(TooManyRequests):
+    """Raised (and served as a 429) when the hashing pool is at its admission limit"""
+    description = 'The server is handling too many sign-ins right now. Please try again in a moment.'
+
+    def get_headers(self, environ=None, scope=None):
+        return super().get_headers(environ, scope) + [('Retry-After', '1')]
+
+
+class PasswordHasher:
+    """Process pool for password hashes with a cap on pending work"""
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Started lazily so gunicorn forks its workers before the pool exists; spawned
+        # rather than forked, since forking a process that runs threads is unsafe
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def run(self, fn, *args):
+        """Run fn(*args) in the pool and wait for the result, or raise PasswordHashingBusy"""
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHashingBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+_password_hasher = None
+_password_hasher_lock = threading.Lock()
+
+def get_password_hasher():
+    """Return the process-wide password hasher, configured from the app config"""
+    global _password_hasher
+    with _password_hasher_lock:
+        if _password_hasher is None:
+            _password_hasher = PasswordHasher(
+                workers=app.config['PASSWORD_HASH_WORKERS'],
+                max_pending=app.config['PASSWORD_HASH_MAX_PENDING']
+            )
+        return _password_hasher
+
+def hash_password(password):
+    return get_password_hasher().run(generate_password_hash, password)
+
+def verify_password(password_hash, password):
+    return get_password_hasher().run(check_password_hash, password_hash, password)
@@ -0,0 +1,94 @@
+"""
+Process-local cache of the portal catalogue
+
+Portals change rarely, so every process keeps the list in memory and serves
+reads from it. Each entry is a plain snapshot of the portal's columns, safe to
+share between requests and threads.
+
+Writes to portals call invalidate_portals() before committing, which bumps the
+'portals' CacheVersion row in the same transaction, and clear_portal_cache()
+after committing, which drops this process's copy. Clearing only once the
+write is visible means no request can reload the old rows in between. Other
+processes compare their copy against that counter at most every
+PORTAL_CACHE_TTL seconds, so a change reaches every gunicorn worker within
+one TTL while most reads don't touch the database at all.
+"""
+import threading
+import time
+from types import SimpleNamespace
+
+from app import app, db
+from models import CacheVersion, Portal
+
+CACHE_NAME = 'portals'
+
+
+class PortalCatalogue:
+    """The cached portal list and the database version it was loaded at"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._portals = None
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def _database_version(self):
+        version = db.session.query(CacheVersion.version).filter_by(name=CACHE_NAME).scalar()
+        return version or 0
+
+    def _refresh(self):
+        # Read the version before the rows: a write in between only makes us reload once more
+        version = self._database_version()
+        if self._portals is None or version != self._version:
+            self._portals = [
+                SimpleNamespace(**{column.key: getattr(portal, column.key) for column in Portal.__table__.columns})
+                for portal in Portal.query.order_by(Portal.id)
+            ]
+            self._version = version
+        self._checked_at = time.monotonic()
+
+    def get(self):
+        """Return (version, portals), rechecking the database if the copy is older than the TTL"""
+        with self._lock:
+            if self._portals is None or time.monotonic() - self._checked_at >= self.ttl:
+                self._refresh()
+            return self._version, self._portals
+
+    def clear(self):
+        with self._lock:
+            self._portals = None
+
+
+_catalogue = None
+_catalogue_lock = threading.Lock()
+
+def _get_catalogue():
+    global _catalogue
+    with _catalogue_lock:
+        if _catalogue is None:
+            _catalogue = PortalCatalogue(ttl=app.config['PORTAL_CACHE_TTL'])
+        return _catalogue
+
+def get_portals():
+    """Return snapshots of all portals, ordered by id"""
+    return _get_catalogue().get()[1]
+
+def get_portal_catalogue_version():
+    """Return the version of the portal list, which changes whenever a portal is added, edited or deleted"""
+    return _get_catalogue().get()[0]
+
+def invalidate_portals():
+    """
+    Mark the portal list as changed, as part of the current transaction
+    Call before committing a portal write; the caller's commit publishes it to other processes
+    """
+    bumped = CacheVersion.query.filter_by(name=CACHE_NAME).update(
+        {'version': CacheVersion.version + 1}, synchronize_session=False
+    )
+    if not bumped:
+        db.session.add(CacheVersion(name=CACHE_NAME, version=1))
+
+def clear_portal_cache():
+    """Drop this process's copy of the portal list; call after committing a portal write"""
+    _get_catalogue().clear()
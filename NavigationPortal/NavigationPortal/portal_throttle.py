@@ -0,0 +1,163 @@
+"""
+Per-portal rate limiting shared by every download worker
+
+Each portal with limits configured has a PortalThrottle row holding a token
+bucket (Portal.rate_limit requests per second, up to Portal.rate_limit_burst
+saved up). Workers update the row with compare-and-set on its version, so
+the limits hold across processes and hosts on both Postgres and SQLite.
+
+Requests in flight to a portal capped by Portal.max_concurrent_requests each
+hold a PortalRequestSlot row, taken under the same compare-and-set. A slot
+belongs to a download and expires with its lease: the heartbeat extends the
+slots of downloads still running, and a slot whose worker died, or whose
+release never reached the database, lapses and is deleted.
+"""
+import asyncio
+import math
+import random
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import PortalRequestSlot, PortalThrottle
+from fetch_engine import run_blocking
+
+# How long to wait before asking again when a portal is at its concurrency cap
+CONCURRENCY_RETRY_SECONDS = 0.5
+
+
+class PortalSlotTimeout(Exception):
+    """
+    A download waited longer than PORTAL_SLOT_WAIT_TIMEOUT for a portal's limits to allow a request
+    Not a transient error: the download fails rather than queueing for the slot all over again
+    """
+
+
+def _limit(value):
+    """A configured limit, or None when it is unset or not a finite number (rows written before validation)"""
+    if value is None or not math.isfinite(value) or value <= 0:
+        return None
+    return value
+
+def _bucket_size(rate_limit, rate_limit_burst):
+    return _limit(rate_limit_burst) or max(1, int(_limit(rate_limit) or 1))
+
+def download_cap(rate_limit, rate_limit_burst, max_concurrent_requests):
+    """
+    How many downloads of a portal are worth running at once, or None when it has no limits
+    Beyond the concurrency cap, or beyond what the token bucket can serve at once, extra
+    downloads would only sit waiting for a slot
+    """
+    rate_limit, max_concurrent_requests = _limit(rate_limit), _limit(max_concurrent_requests)
+    caps = []
+    if max_concurrent_requests:
+        caps.append(max_concurrent_requests)
+    if rate_limit:
+        caps.append(_bucket_size(rate_limit, rate_limit_burst))
+    return min(caps) if caps else None
+
+def try_acquire(portal_id, download_id, rate_limit, rate_limit_burst, max_concurrent_requests):
+    """
+    Take one request slot for a portal on behalf of a download
+    Returns (0, slot id) when the slot was granted, the slot id being None when the portal has no
+    concurrency cap, otherwise (seconds to wait before retrying, None)
+    """
+    bucket_size = _bucket_size(rate_limit, rate_limit_burst)
+
+    for _ in range(5):
+        throttle = db.session.get(PortalThrottle, portal_id)
+        if throttle is None:
+            db.session.add(PortalThrottle(portal_id=portal_id, tokens=bucket_size,
+                                          refilled_at=datetime.utcnow(), version=0))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another worker created it first
+                db.session.rollback()
+            continue
+
+        now = datetime.utcnow()
+        if max_concurrent_requests:
+            held = PortalRequestSlot.query.filter(
+                PortalRequestSlot.portal_id == portal_id,
+                PortalRequestSlot.expires_at >= now
+            ).count()
+            if held >= max_concurrent_requests:
+                db.session.rollback()
+                return CONCURRENCY_RETRY_SECONDS, None
+
+        tokens = throttle.tokens
+        if rate_limit:
+            elapsed = max((now - throttle.refilled_at).total_seconds(), 0)
+            tokens = min(bucket_size, tokens + elapsed * rate_limit)
+            if tokens < 1:
+                db.session.rollback()
+                return (1 - tokens) / rate_limit, None
+            tokens -= 1
+
+        # The slot is written in the same transaction as the compare-and-set, so two workers that
+        # both saw room for one more request cannot both take it
+        granted = PortalThrottle.query.filter_by(portal_id=portal_id, version=throttle.version).update({
+            'tokens': tokens,
+            'refilled_at': now,
+            'version': PortalThrottle.version + 1
+        }, synchronize_session=False)
+        if not granted:
+            db.session.rollback()
+            continue
+        slot = None
+        if max_concurrent_requests:
+            slot = PortalRequestSlot(
+                portal_id=portal_id, download_id=download_id,
+                expires_at=now + timedelta(seconds=app.config['DOWNLOAD_LEASE_SECONDS'])
+            )
+            db.session.add(slot)
+        db.session.commit()
+        return 0, slot.id if slot is not None else None
+
+    # Lost the race to other workers several times in a row; back off briefly
+    return random.uniform(0.05, 0.2), None
+
+def release(slot_id):
+    """Give back a request slot taken with try_acquire"""
+    PortalRequestSlot.query.filter_by(id=slot_id).delete(synchronize_session=False)
+    db.session.commit()
+
+def reclaim_expired_slots():
+    """Delete the slots left behind by workers that died mid-request or failed to release them"""
+    reclaimed = PortalRequestSlot.query.filter(
+        PortalRequestSlot.expires_at < datetime.utcnow()
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return reclaimed
+
+@asynccontextmanager
+async def portal_request_slot(portal_id, download_id, rate_limit=None, rate_limit_burst=None, max_concurrent_requests=None):
+    """
+    Wait, without blocking the event loop, until the portal's limits allow one more request
+    Raises PortalSlotTimeout after waiting PORTAL_SLOT_WAIT_TIMEOUT seconds
+    """
+    rate_limit, max_concurrent_requests = _limit(rate_limit), _limit(max_concurrent_requests)
+    if not rate_limit and not max_concurrent_requests:
+        yield
+        return
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + app.config['PORTAL_SLOT_WAIT_TIMEOUT']
+    while True:
+        wait, slot_id = await run_blocking(
+            try_acquire, portal_id, download_id, rate_limit, rate_limit_burst, max_concurrent_requests
+        )
+        if not wait:
+            break
+        if loop.time() + wait > deadline:
+            raise PortalSlotTimeout(f"Portal {portal_id} did not allow a request within "
+                                    f"{app.config['PORTAL_SLOT_WAIT_TIMEOUT']} seconds")
+        await asyncio.sleep(wait)
+    try:
+        yield
+    finally:
+        if slot_id is not None:
+            await run_blocking(release, slot_id)
@@ -0,0 +1,323 @@
+"""
+Download progress reporting
+
+Each running download reports through its own ProgressReporter, which drops
+updates that are too small or too frequent to be worth a write. Whatever is
+left is collected by the process-wide ProgressFlusher and written for every
+download at once with a single batched UPDATE.
+
+The flusher also publishes the live progress and ETA of every running
+download to the ProgressStore, a SQLite file in WAL mode that all processes
+on the host share, so status polls can be answered without the main database.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import case
+
+from app import app, db
+from models import Download
+
+
+class ProgressStore:
+    """
+    Live progress of running downloads, shared by every process on this host
+    Readers and writers each use their own connection; WAL mode lets them run concurrently
+    """
+
+    def __init__(self, path, stale_after):
+        self.path = path
+        self.stale_after = stale_after
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS live_progress ('
+                ' download_id INTEGER PRIMARY KEY, user_id INTEGER, progress INTEGER,'
+                ' eta_seconds REAL, download_type TEXT, facility_username TEXT,'
+                ' created_at TEXT, updated_at TEXT)'
+            )
+            self._local.connection = connection
+        return connection
+
+    def put_many(self, entries):
+        """Insert or replace the live entries for several downloads at once"""
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO live_progress VALUES'
+                ' (:download_id, :user_id, :progress, :eta_seconds, :download_type,'
+                ' :facility_username, :created_at, :updated_at)',
+                entries
+            )
+
+    def delete_many(self, download_ids):
+        connection = self._connection()
+        with connection:
+            connection.executemany('DELETE FROM live_progress WHERE download_id = ?',
+                                   [(download_id,) for download_id in download_ids])
+
+    def _is_fresh(self, entry):
+        # An entry nobody republished for stale_after seconds belongs to a dead worker;
+        # the database is authoritative for it
+        age = (datetime.utcnow() - datetime.fromisoformat(entry['updated_at'])).total_seconds()
+        return age <= self.stale_after
+
+    def get(self, download_id):
+        """Return the live entry for a running download, or None if it has none or it went stale"""
+        row = self._connection().execute(
+            'SELECT * FROM live_progress WHERE download_id = ?', (download_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        return entry if self._is_fresh(entry) else None
+
+    def get_many(self, download_ids):
+        """Return the live entries for several downloads, keyed by download id"""
+        download_ids = list(download_ids)
+        if not download_ids:
+            return {}
+        placeholders = ', '.join('?' * len(download_ids))
+        rows = self._connection().execute(
+            f'SELECT * FROM live_progress WHERE download_id IN ({placeholders})', download_ids
+        ).fetchall()
+        return {entry['download_id']: entry for entry in map(dict, rows) if self._is_fresh(entry)}
+
+    def get_for_user(self, user_id):
+        """Return the live entries of all of a user's running downloads"""
+        rows = self._connection().execute(
+            'SELECT * FROM live_progress WHERE user_id = ?', (user_id,)
+        ).fetchall()
+        return [entry for entry in map(dict, rows) if self._is_fresh(entry)]
+
+
+class ProgressFlusher:
+    """
+    Collects pending progress from all downloads and writes it in one UPDATE per interval
+    Live entries are republished to the store on every change and at least every refresh_interval
+    """
+
+    def __init__(self, flush_interval, store, refresh_interval):
+        self.flush_interval = flush_interval
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self._pending = {}
+        self._live = {}
+        self._live_changed = set()
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+        # Held while writing to the store, so an entry snapshotted before discard() is never put back after it
+        self._store_lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_started(self):
+        # Started lazily so gunicorn forks its workers before the thread exists
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="progress-flusher")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def enqueue(self, download_id, progress):
+        self._ensure_started()
+        with self._lock:
+            self._pending[download_id] = progress
+
+    def publish(self, download_id, progress, meta):
+        """Record the live progress of a download for the shared store"""
+        self._ensure_started()
+        with self._lock:
+            self._live[download_id] = dict(meta, progress=progress)
+            self._live_changed.add(download_id)
+
+    def discard(self, download_id):
+        """
+        Forget unwritten progress and unpublish the live entry, e.g. once the download has reached a final state
+        The entry is deleted from the store before returning, so once the final status is written no
+        reader can see the download as still running
+        """
+        with self._store_lock:
+            with self._lock:
+                self._pending.pop(download_id, None)
+                self._live.pop(download_id, None)
+                self._live_changed.discard(download_id)
+            self.store.delete_many([download_id])
+
+    def close(self):
+        """Write all pending progress and unpublish every live entry; call when the process stops running downloads"""
+        self.flush()
+        with self._store_lock:
+            with self._lock:
+                published = list(self._live)
+                self._live.clear()
+                self._live_changed.clear()
+            if published:
+                self.store.delete_many(published)
+
+    def flush(self):
+        """Write all pending progress values with a single UPDATE and publish live progress"""
+        self._publish_live()
+        
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        # Only running downloads are touched, so a late flush never rewinds a finished one
+        updated = Download.query.filter(
+            Download.id.in_(pending.keys()),
+            Download.status == 'in_progress'
+        ).update({
+            'progress': case(pending, value=Download.id)
+        }, synchronize_session=False)
+        db.session.commit()
+        return updated
+
+    def _publish_live(self):
+        with self._store_lock:
+            self._write_live()
+
+    def _write_live(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_refresh >= self.refresh_interval:
+                # Republish everything so readers can tell live entries from stale ones
+                self._live_changed.update(self._live)
+                self._last_refresh = now
+            changed = [self._live[download_id] for download_id in self._live_changed]
+            self._live_changed.clear()
+
+        timestamp = datetime.utcnow()
+        entries = []
+        for entry in changed:
+            started_at = entry['started_at']
+            elapsed_seconds = (timestamp - started_at).total_seconds()
+            eta_seconds = None
+            if entry['progress'] > 0 and elapsed_seconds > 0:
+                eta_seconds = (elapsed_seconds / entry['progress']) * (100 - entry['progress'])
+            entries.append({
+                'download_id': entry['download_id'],
+                'user_id': entry['user_id'],
+                'progress': entry['progress'],
+                'eta_seconds': eta_seconds,
+                'download_type': entry['download_type'],
+                'facility_username': entry['facility_username'],
+                'created_at': entry['created_at'].isoformat(),
+                'updated_at': timestamp.isoformat(),
+            })
+        if entries:
+            self.store.put_many(entries)
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception:
+                    logging.exception("Failed to flush download progress")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+class ProgressReporter:
+    """
+    Progress updates for one download
+    A value is passed on only if it moved by at least min_delta percentage points
+    or min_interval seconds have passed since the last value passed on
+    """
+
+    def __init__(self, download_id, flusher, min_delta, min_interval):
+        self.download_id = download_id
+        self.flusher = flusher
+        self.min_delta = min_delta
+        self.min_interval = min_interval
+        self._meta = None
+        self._last_progress = None
+        self._last_reported_at = 0
+
+    def start(self, user_id, download_type, facility_username, created_at, progress=0):
+        """Publish the download to the live progress store"""
+        self._meta = {
+            'download_id': self.download_id,
+            'user_id': user_id,
+            'download_type': download_type,
+            'facility_username': facility_username,
+            'created_at': created_at,
+            'started_at': datetime.utcnow(),
+        }
+        self.flusher.publish(self.download_id, progress, self._meta)
+
+    def report(self, progress):
+        """Record the download's progress (0-100); never blocks on the database"""
+        if self._meta is not None:
+            self.flusher.publish(self.download_id, progress, self._meta)
+        
+        now = time.monotonic()
+        if self._last_progress is not None:
+            if progress == self._last_progress:
+                return
+            if abs(progress - self._last_progress) < self.min_delta and now - self._last_reported_at < self.min_interval:
+                return
+        self._last_progress = progress
+        self._last_reported_at = now
+        self.flusher.enqueue(self.download_id, progress)
+
+    def close(self):
+        """
+        Drop anything unwritten and unpublish; the final status write carries the final progress
+        Call before writing the final status: the live entry is gone once this returns
+        """
+        self.flusher.discard(self.download_id)
+
+
+_progress_store = None
+_progress_flusher = None
+_progress_lock = threading.Lock()
+
+def get_progress_store():
+    """Return the live progress store for this host, configured from the app config"""
+    global _progress_store
+    with _progress_lock:
+        if _progress_store is None:
+            _progress_store = ProgressStore(
+                path=app.config['PROGRESS_STORE_PATH'],
+                stale_after=app.config['DOWNLOAD_LEASE_SECONDS']
+            )
+        return _progress_store
+
+def get_progress_flusher():
+    """Return the process-wide progress flusher, configured from the app config"""
+    global _progress_flusher
+    store = get_progress_store()
+    with _progress_lock:
+        if _progress_flusher is None:
+            _progress_flusher = ProgressFlusher(
+                flush_interval=app.config['DOWNLOAD_PROGRESS_FLUSH_INTERVAL'],
+                store=store,
+                refresh_interval=app.config['DOWNLOAD_LEASE_SECONDS'] / 3
+            )
+        return _progress_flusher
+
+def progress_reporter(download_id):
+    """Return a coalescing progress reporter scoped to one download"""
+    return ProgressReporter(
+        download_id,
+        get_progress_flusher(),
+        min_delta=app.config['DOWNLOAD_PROGRESS_MIN_DELTA'],
+        min_interval=app.config['DOWNLOAD_PROGRESS_MIN_INTERVAL']
+    )
@@ -0,0 +1,85 @@
+"""
+Query budgets for pages and API endpoints
+
+Counts the SQL statements a block of code sends to the database so N+1
+regressions (one extra SELECT per row from a lazy relationship) get caught:
+
+    with query_budget(3):
+        client.get('/download-history')
+
+raises QueryBudgetExceeded if the page issued more than three statements.
+Setting QUERY_BUDGET_PER_REQUEST also logs every request that goes over it.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+
+from app import app, db
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a block issued more queries than its budget allows"""
+
+    def __init__(self, budget, statements):
+        self.budget = budget
+        self.statements = statements
+        listing = '\n'.join(f'  {statement}' for statement in statements)
+        super().__init__(f'{len(statements)} queries issued, budget is {budget}:\n{listing}')
+
+
+_counters = threading.local()
+_listening_engines = set()
+_listening_lock = threading.Lock()
+
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    for recorded in getattr(_counters, 'stack', ()):
+        recorded.append(statement)
+
+def _listen(engine):
+    with _listening_lock:
+        if engine not in _listening_engines:
+            event.listen(engine, 'before_cursor_execute', _record_statement)
+            _listening_engines.add(engine)
+
+@contextmanager
+def count_queries():
+    """Collect the SQL statements this thread sends to the database inside the block"""
+    with app.app_context():
+        _listen(db.engine)
+    statements = []
+    stack = _counters.__dict__.setdefault('stack', [])
+    stack.append(statements)
+    try:
+        yield statements
+    finally:
+        stack.remove(statements)
+
+@contextmanager
+def query_budget(budget):
+    """Fail with QueryBudgetExceeded if the block sends more than budget SQL statements"""
+    with count_queries() as statements:
+        yield statements
+    if len(statements) > budget:
+        raise QueryBudgetExceeded(budget, statements)
+
+
+@app.before_request
+def start_counting_queries():
+    if app.config['QUERY_BUDGET_PER_REQUEST']:
+        g.query_counter = count_queries()
+        g.query_statements = g.query_counter.__enter__()
+
+@app.teardown_request
+def check_query_budget(exc=None):
+    counter = g.pop('query_counter', None)
+    if counter is None:
+        return
+    counter.__exit__(None, None, None)
+    statements = g.pop('query_statements')
+    budget = app.config['QUERY_BUDGET_PER_REQUEST']
+    if len(statements) > budget:
+        logging.warning("%s %s issued %d queries (budget %d)",
+                        request.method, request.path, len(statements), budget)
@@ -1,7 +1,9 @@
-from app import app, db
-import models
+from app import app, configure_app
+from migrations import drop_all, upgrade
+
+configure_app()
 
 with app.app_context():
-    db.drop_all()
-    db.create_all()
+    drop_all()
+    upgrade()
     print("Database tables dropped and recreated successfully")
@@ -0,0 +1,120 @@
+"""
+Reuse of finished downloads for identical requests
+
+Users often schedule the same download several times within minutes. Each
+finished download is remembered under a hash of its request parameters, and
+a repeat request within the portal's result cache TTL completes at once by
+pointing at the same stored file instead of fetching from the portal again.
+
+Entries live in the database, so a result finished by a worker process is
+found by every web process. They take no reference on the file themselves:
+each points at its download, whose reference keeps the file in the store, and
+is deleted along with it. The DOWNLOAD_RESULT_CACHE_SIZE most recently used
+entries are kept.
+"""
+import hashlib
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import Download, DownloadResultCache, StoredFile
+from portal_cache import get_portals
+
+
+def result_cache_key(portal_id, credential_id, download_type, facility_username, start_date, end_date):
+    """Hash of the parameters that identify a download request"""
+    parameters = [
+        str(int(portal_id)), str(int(credential_id)), download_type or '', facility_username or '',
+        start_date.isoformat(), end_date.isoformat()
+    ]
+    return hashlib.sha256('\n'.join(parameters).encode()).hexdigest()
+
+def _download_cache_key(download):
+    return result_cache_key(
+        download.portal_id, download.credential_id, download.download_type,
+        download.facility_username, download.start_date, download.end_date
+    )
+
+def result_cache_ttl(portal_id):
+    """Seconds a portal's results are reused for; 0 when the portal doesn't cache them"""
+    for portal in get_portals():
+        if portal.id == portal_id and portal.result_cache_ttl is not None:
+            return portal.result_cache_ttl
+    return app.config['DOWNLOAD_RESULT_CACHE_TTL']
+
+
+def complete_from_cache(download):
+    """
+    Complete a new download from the cached result of an identical request, if there is a fresh one
+    Returns whether it did; the caller commits either way, and schedules the download if not
+    """
+    ttl = result_cache_ttl(download.portal_id)
+    if ttl <= 0:
+        return False
+
+    now = datetime.utcnow()
+    cached = db.session.query(DownloadResultCache, Download).join(
+        Download, Download.id == DownloadResultCache.download_id
+    ).filter(
+        DownloadResultCache.cache_key == _download_cache_key(download),
+        DownloadResultCache.stored_at >= now - timedelta(seconds=ttl),
+        Download.status == 'completed',
+        Download.file_path.isnot(None)
+    ).first()
+    if cached is None:
+        return False
+    entry, source = cached
+
+    # The cached download's reference keeps the file in the store; the new download takes its own
+    referenced = StoredFile.query.filter_by(file_path=source.file_path).update(
+        {'ref_count': StoredFile.ref_count + 1}, synchronize_session=False
+    )
+    if not referenced:
+        return False
+
+    download.file_path = source.file_path
+    download.compression = source.compression
+    download.file_size = source.file_size
+    download.content_size = source.content_size
+    download.status = 'completed'
+    download.progress = 100
+    entry.last_used_at = now
+    return True
+
+
+def remember_download_result(download_id):
+    """Make a completed download the cached result for its request parameters; returns whether it was cached"""
+    download = db.session.get(Download, download_id)
+    if download is None or download.file_path is None or result_cache_ttl(download.portal_id) <= 0:
+        db.session.rollback()
+        return False
+    cache_key = _download_cache_key(download)
+    portal_id = download.portal_id
+
+    for _ in range(5):
+        now = datetime.utcnow()
+        values = {'portal_id': portal_id, 'download_id': download_id, 'stored_at': now, 'last_used_at': now}
+        replaced = DownloadResultCache.query.filter_by(cache_key=cache_key).update(values, synchronize_session=False)
+        if not replaced:
+            db.session.add(DownloadResultCache(cache_key=cache_key, **values))
+        try:
+            db.session.commit()
+            break
+        except IntegrityError:
+            # An identical download finished at the same moment; overwrite its entry instead
+            db.session.rollback()
+    else:
+        raise RuntimeError(f"Could not cache the result of download {download_id}")
+
+    evict_least_recently_used()
+    return True
+
+def evict_least_recently_used():
+    """Drop the entries beyond DOWNLOAD_RESULT_CACHE_SIZE, least recently used first"""
+    cutoff = db.session.query(DownloadResultCache.last_used_at).order_by(
+        DownloadResultCache.last_used_at.desc()
+    ).offset(app.config['DOWNLOAD_RESULT_CACHE_SIZE']).limit(1).scalar()
+    if cutoff is not None:
+        DownloadResultCache.query.filter(DownloadResultCache.last_used_at <= cutoff).delete(synchronize_session=False)
+    db.session.commit()
@@ -1,17 +1,48 @@
 import os
-from flask import render_template, redirect, url_for, flash, request, session, jsonify
+import json
+import math
+import time
+import base64
+import hashlib
+import threading
+from flask import render_template, redirect, url_for, flash, request, session, jsonify, Response, stream_with_context, abort, send_file
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
 from functools import wraps
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import joinedload
 
 from app import app, db
-from models import User, Portal, Credential, Download
-from download_scheduler import schedule_download_job
+from models import User, Portal, Credential, Download, StoredFile
+from download_scheduler import schedule_download_job, get_worker_pool
+from download_output import content_encoding, open_stored_file, resolve_download_file
+from progress import get_progress_store
+from identity_cache import get_identity, bump_account_version, invalidate_identity, publish_identity_change
+from portal_cache import get_portals, get_portal_catalogue_version, invalidate_portals, clear_portal_cache
+from result_cache import complete_from_cache
+from query_budget import check_query_budget, start_counting_queries  # noqa: F401 (registers the hooks)
+
+def current_identity():
+    """
+    Identity of the signed-in user from the identity cache, or None if nobody is signed in
+    Ends the session of a deleted user and refreshes the session after a role change
+    """
+    if 'user_id' not in session:
+        return None
+    
+    identity = get_identity(session['user_id'])
+    if identity is None:
+        session.clear()
+        return None
+    if identity.account_version != session.get('account_version'):
+        session['is_admin'] = identity.is_admin
+        session['account_version'] = identity.account_version
+    return identity
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if current_identity() is None:
             flash('Please login to access this page', 'warning')
             return redirect(url_for('login'))
         return f(*args, **kwargs)
@@ -20,17 +51,40 @@ def login_required(f):
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        identity = current_identity()
+        if identity is None:
             flash('Please login to access this page', 'warning')
             return redirect(url_for('login'))
         
-        user = User.query.get(session['user_id'])
-        if not user or not user.is_admin:
+        if not identity.is_admin:
             flash('You need admin privileges to access this page', 'danger')
             return redirect(url_for('index'))
         return f(*args, **kwargs)
     return decorated_function
 
+def make_etag(*parts):
+    """Build an ETag from the values that identify a version of a response"""
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+def not_modified(etag):
+    """Return an empty 304 response if the client already holds this version, otherwise None"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        return with_etag(response, etag)
+    return None
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    # Per-user data: browsers may keep it but must revalidate every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.before_request
+def start_download_workers():
+    # Begin draining the download queue (including jobs left over from a restart)
+    if app.config['DOWNLOAD_EMBEDDED_WORKERS']:
+        get_worker_pool().start()
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -54,6 +108,7 @@ def login():
         session['user_id'] = user.id
         session['username'] = user.username
         session['is_admin'] = user.is_admin
+        session['account_version'] = user.account_version or 0
         
         flash(f'Welcome back, {user.username}!', 'success')
         return redirect(url_for('index'))
@@ -150,7 +205,9 @@ def toggle_admin(user_id):
         return redirect(url_for('user_management'))
     
     user.is_admin = not user.is_admin
+    bump_account_version(user)
     db.session.commit()
+    invalidate_identity(user_id)
     
     action = 'promoted to admin' if user.is_admin else 'demoted from admin'
     flash(f'User {user.username} was {action}', 'success')
@@ -173,15 +230,35 @@ def delete_user(user_id):
     
     username = user.username
     db.session.delete(user)
+    publish_identity_change()
     db.session.commit()
+    invalidate_identity(user_id)
     
     flash(f'User {username} was deleted successfully', 'success')
     return redirect(url_for('user_management'))
 
+def parse_portal_limits(form):
+    """Read the optional limit fields of the portal forms; blank means unlimited (or, for the cache TTL, the default)"""
+    def optional(name, cast, minimum=None):
+        value = form.get(name, '').strip()
+        if not value:
+            return None
+        value = cast(value)
+        if not math.isfinite(value) or (value <= 0 if minimum is None else value < minimum):
+            raise ValueError(name)
+        return value
+    
+    return {
+        'rate_limit': optional('rate_limit', float),
+        'rate_limit_burst': optional('rate_limit_burst', int),
+        'max_concurrent_requests': optional('max_concurrent_requests', int),
+        'result_cache_ttl': optional('result_cache_ttl', int, minimum=0),
+    }
+
 @app.route('/portal-config')
 @login_required
 def portal_config():
-    portals = Portal.query.all()
+    portals = get_portals()
     return render_template('portal_config.html', portals=portals)
 
 @app.route('/add-portal', methods=['POST'])
@@ -195,13 +272,21 @@ def add_portal():
         flash('Portal name and URL are required', 'danger')
         return redirect(url_for('portal_config'))
     
+    try:
+        limits = parse_portal_limits(request.form)
+    except ValueError:
+        flash('Rate limits must be finite positive numbers and the result cache TTL zero or more', 'danger')
+        return redirect(url_for('portal_config'))
+    
     if Portal.query.filter_by(name=name).first():
         flash('Portal with this name already exists', 'danger')
         return redirect(url_for('portal_config'))
     
-    portal = Portal(name=name, url=url, description=description)
+    portal = Portal(name=name, url=url, description=description, **limits)
     db.session.add(portal)
+    invalidate_portals()
     db.session.commit()
+    clear_portal_cache()
     
     flash(f'Portal {name} added successfully', 'success')
     return redirect(url_for('portal_config'))
@@ -219,6 +304,12 @@ def edit_portal(portal_id):
         flash('Portal name and URL are required', 'danger')
         return redirect(url_for('portal_config'))
     
+    try:
+        limits = parse_portal_limits(request.form)
+    except ValueError:
+        flash('Rate limits must be finite positive numbers and the result cache TTL zero or more', 'danger')
+        return redirect(url_for('portal_config'))
+    
     # Check if the updated name conflicts with another portal's name
     existing_portal = Portal.query.filter_by(name=name).first()
     if existing_portal and existing_portal.id != portal_id:
@@ -228,7 +319,13 @@ def edit_portal(portal_id):
     portal.name = name
     portal.url = url
     portal.description = description
+    portal.rate_limit = limits['rate_limit']
+    portal.rate_limit_burst = limits['rate_limit_burst']
+    portal.max_concurrent_requests = limits['max_concurrent_requests']
+    portal.result_cache_ttl = limits['result_cache_ttl']
+    invalidate_portals()
     db.session.commit()
+    clear_portal_cache()
     
     flash(f'Portal {name} updated successfully', 'success')
     return redirect(url_for('portal_config'))
@@ -240,7 +337,9 @@ def delete_portal(portal_id):
     name = portal.name
     
     db.session.delete(portal)
+    invalidate_portals()
     db.session.commit()
+    clear_portal_cache()
     
     flash(f'Portal {name} deleted successfully', 'success')
     return redirect(url_for('portal_config'))
@@ -249,8 +348,8 @@ def delete_portal(portal_id):
 @login_required
 def user_credentials():
     user_id = session.get('user_id')
-    portals = Portal.query.all()
-    credentials = Credential.query.filter_by(user_id=user_id).all()
+    portals = get_portals()
+    credentials = Credential.query.filter_by(user_id=user_id).options(joinedload(Credential.portal)).all()
     return render_template('user_credentials.html', portals=portals, credentials=credentials)
 
 @app.route('/add-credential', methods=['POST'])
@@ -328,7 +427,7 @@ def delete_credential(credential_id):
 @login_required
 def download_operation():
     user_id = session.get('user_id')
-    credentials = Credential.query.filter_by(user_id=user_id).all()
+    credentials = Credential.query.filter_by(user_id=user_id).options(joinedload(Credential.portal)).all()
     return render_template('download_operation.html', credentials=credentials)
 
 @app.route('/schedule-download', methods=['POST'])
@@ -340,6 +439,8 @@ def schedule_download():
     download_type = request.form.get('download_type', 'submission')
     start_date_str = request.form.get('start_date')
     end_date_str = request.form.get('end_date')
+    # Fetch every day from the portal, ignoring recent identical results and days already covered
+    force_refresh = request.form.get('force_refresh') == '1'
     
     if not credential_id or not start_date_str or not end_date_str or not facility_username:
         # Check if this is an AJAX request
@@ -386,37 +487,55 @@ def schedule_download():
         start_date=start_date,
         end_date=end_date,
         status='scheduled',
-        progress=0
+        progress=0,
+        force_refresh=force_refresh
     )
     
     db.session.add(download)
+    cached = not force_refresh and complete_from_cache(download)
     db.session.commit()
     
-    # Schedule the actual download job
-    schedule_download_job(download.id)
+    if cached:
+        message = 'Download completed from a recent identical download'
+    else:
+        # Schedule the actual download job
+        schedule_download_job(download.id)
+        message = 'Download scheduled successfully'
     
     # Check if this is an AJAX request
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return jsonify({
             'success': True, 
-            'message': 'Download scheduled successfully',
+            'message': message,
             'download_id': download.id
         })
     else:
-        flash('Download scheduled successfully', 'success')
+        flash(message, 'success')
         return redirect(url_for('download_history'))
 
-@app.route('/download-history')
+@app.route('/run-download/<int:download_id>', methods=['POST'])
 @login_required
-def download_history():
+def run_download(download_id):
     user_id = session.get('user_id')
-    downloads = Download.query.filter_by(user_id=user_id).order_by(Download.created_at.desc()).all()
-    return render_template('download_history.html', downloads=downloads)
+    download = Download.query.get_or_404(download_id)
+    
+    # Ensure the download belongs to the logged-in user
+    if download.user_id != user_id:
+        flash('You are not authorized to run this download', 'danger')
+        return redirect(url_for('download_history'))
+    
+    if download.status != 'scheduled':
+        flash('Only scheduled downloads can be run', 'danger')
+        return redirect(url_for('download_history'))
+    
+    schedule_download_job(download.id)
+    flash('Download queued, it will start as soon as a worker is free', 'success')
+    return redirect(url_for('download_history'))
 
-@app.route('/api/download-status/<int:download_id>')
+@app.route('/api/download/<int:download_id>/retry', methods=['POST'])
 @login_required
-def download_status(download_id):
-    """API endpoint to get the current status of a download"""
+def retry_download(download_id):
+    """API endpoint to resume a failed download from its last completed chunk"""
     user_id = session.get('user_id')
     download = Download.query.get_or_404(download_id)
     
@@ -424,36 +543,491 @@ def download_status(download_id):
     if download.user_id != user_id:
         return jsonify({'error': 'Unauthorized access'}), 403
     
-    # Calculate estimated completion time if in progress
-    estimated_completion = None
-    if download.status == 'in_progress' and download.progress > 0:
-        # Simple estimation based on progress and time elapsed
-        elapsed_seconds = (datetime.utcnow() - download.created_at).total_seconds()
-        if elapsed_seconds > 0 and download.progress > 0:
-            seconds_remaining = (elapsed_seconds / download.progress) * (100 - download.progress)
-            minutes_remaining = int(seconds_remaining / 60)
-            if minutes_remaining > 0:
-                estimated_completion = f"About {minutes_remaining} minute(s)"
-            else:
-                estimated_completion = "Less than a minute"
+    if download.status != 'failed':
+        return jsonify({'success': False, 'message': 'Only failed downloads can be retried'}), 400
+    
+    # Chunk checkpoints are kept, so only the missing chunks are fetched again
+    download.status = 'scheduled'
+    download.error_message = None
+    download.attempts = 0
+    download.lease_owner = None
+    download.lease_expires_at = None
+    db.session.commit()
+    
+    schedule_download_job(download.id)
     
     return jsonify({
+        'success': True,
+        'message': 'Download rescheduled, it will resume from the last completed chunk',
+        'download_id': download.id
+    })
+
+DOWNLOAD_FILTERS = ('status', 'download_type', 'portal_id', 'date_from', 'date_to')
+
+def encode_download_cursor(download):
+    """Opaque keyset cursor pointing just past a download in (created_at, id) order"""
+    raw = f"{download.created_at.isoformat()}|{download.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_download_cursor(cursor):
+    created_at, download_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(download_id)
+
+def query_download_page(user_id, args):
+    """
+    One page of a user's downloads, newest first, filtered on the server
+    Pages are keyset-paginated on (created_at, id), so deep pages cost the same as the first
+    Returns (downloads, next_cursor, filters); raises ValueError on malformed arguments
+    """
+    filters = {name: args.get(name, '').strip() for name in DOWNLOAD_FILTERS}
+    page_size = min(args.get('limit', app.config['DOWNLOAD_HISTORY_PAGE_SIZE'], type=int),
+                    app.config['DOWNLOAD_HISTORY_MAX_PAGE_SIZE'])
+    if page_size < 1:
+        raise ValueError('limit')
+    
+    query = Download.query.filter(Download.user_id == user_id)
+    if filters['status']:
+        query = query.filter(Download.status == filters['status'])
+    if filters['download_type']:
+        query = query.filter(Download.download_type == filters['download_type'])
+    if filters['portal_id']:
+        query = query.filter(Download.portal_id == int(filters['portal_id']))
+    # The date range applies to when the download was scheduled
+    if filters['date_from']:
+        query = query.filter(Download.created_at >= datetime.strptime(filters['date_from'], '%Y-%m-%d'))
+    if filters['date_to']:
+        date_to = datetime.strptime(filters['date_to'], '%Y-%m-%d') + timedelta(days=1)
+        query = query.filter(Download.created_at < date_to)
+    
+    cursor = args.get('cursor')
+    if cursor:
+        created_at, download_id = decode_download_cursor(cursor)
+        query = query.filter(or_(
+            Download.created_at < created_at,
+            and_(Download.created_at == created_at, Download.id < download_id)
+        ))
+    
+    # Fetch one extra row to learn whether there is a next page; portal and credential
+    # come back in the same SELECT so the page doesn't issue two more per row
+    downloads = query.options(
+        joinedload(Download.portal),
+        joinedload(Download.credential)
+    ).order_by(Download.created_at.desc(), Download.id.desc()).limit(page_size + 1).all()
+    next_cursor = None
+    if len(downloads) > page_size:
+        downloads = downloads[:page_size]
+        next_cursor = encode_download_cursor(downloads[-1])
+    
+    return downloads, next_cursor, filters
+
+@app.route('/download-history')
+@login_required
+def download_history():
+    user_id = session.get('user_id')
+    
+    try:
+        downloads, next_cursor, filters = query_download_page(user_id, request.args)
+    except (ValueError, TypeError):
+        flash('Invalid filter or page', 'danger')
+        return redirect(url_for('download_history'))
+    
+    portals = sorted(get_portals(), key=lambda portal: portal.name)
+    # Only the filters in use are carried over into the paging links
+    filter_args = {name: value for name, value in filters.items() if value}
+    return render_template('download_history.html', downloads=downloads, next_cursor=next_cursor,
+                           filters=filters, filter_args=filter_args, portals=portals,
+                           is_first_page=not request.args.get('cursor'))
+
+@app.route('/api/downloads')
+@login_required
+def api_downloads():
+    """API endpoint to page through the user's downloads with the same filters as the history page"""
+    user_id = session.get('user_id')
+    
+    try:
+        downloads, next_cursor, filters = query_download_page(user_id, request.args)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid filter or cursor'}), 400
+    
+    return jsonify({
+        'downloads': [
+            dict(
+                download_status_payload(download),
+                id=download.id,
+                portal_id=download.portal_id,
+                credential_id=download.credential_id,
+                start_date=download.start_date.isoformat(),
+                end_date=download.end_date.isoformat(),
+                compression=download.compression,
+                file_size=download.file_size,
+                content_size=download.content_size,
+                bytes_read=download.bytes_read
+            )
+            for download in downloads
+        ],
+        'next_cursor': next_cursor
+    })
+
+def format_estimated_completion(seconds_remaining):
+    minutes_remaining = int(seconds_remaining / 60)
+    if minutes_remaining > 0:
+        return f"About {minutes_remaining} minute(s)"
+    return "Less than a minute"
+
+def estimate_completion(status, progress, created_at):
+    """Calculate estimated completion time if in progress"""
+    if status == 'in_progress' and progress > 0:
+        # Simple estimation based on progress and time elapsed
+        elapsed_seconds = (datetime.utcnow() - created_at).total_seconds()
+        if elapsed_seconds > 0:
+            seconds_remaining = (elapsed_seconds / progress) * (100 - progress)
+            return format_estimated_completion(seconds_remaining)
+    return None
+
+def download_status_payload(download):
+    """Status of a download as returned by the status APIs, from its database row"""
+    estimated_completion = estimate_completion(download.status, download.progress, download.created_at)
+    
+    return {
         'status': download.status,
         'progress': download.progress,
         'started_at': download.created_at.isoformat(),
         'updated_at': download.updated_at.isoformat(),
-        'file_path': download.file_path,
+        'file_url': url_for('download_file', download_id=download.id) if download.file_path else None,
         'error_message': download.error_message,
         'estimated_completion': estimated_completion,
         'download_type': download.download_type,
         'facility_username': download.facility_username
+    }
+
+def live_status_payload(live):
+    """Status of a running download as returned by the status APIs, from its live progress entry"""
+    estimated_completion = None
+    if live['eta_seconds'] is not None:
+        estimated_completion = format_estimated_completion(live['eta_seconds'])
+    
+    return {
+        'status': 'in_progress',
+        'progress': live['progress'],
+        'started_at': live['created_at'],
+        'updated_at': live['updated_at'],
+        'file_url': None,
+        'error_message': None,
+        'estimated_completion': estimated_completion,
+        'download_type': live['download_type'],
+        'facility_username': live['facility_username']
+    }
+
+def record_bytes_read(download_id, byte_count):
+    """Add to the bytes read from disk to serve a download's file"""
+    if byte_count:
+        Download.query.filter_by(id=download_id).update(
+            {'bytes_read': func.coalesce(Download.bytes_read, 0) + byte_count}, synchronize_session=False
+        )
+        db.session.commit()
+
+@app.route('/downloads/<int:download_id>/file')
+@login_required
+def download_file(download_id):
+    """
+    Serve the result file of a completed download
+    Files stored compressed are sent as-is with a Content-Encoding when the client accepts that
+    encoding, and decompressed on the fly otherwise. Files sent as stored are never read into
+    Python: nginx sends plain ones when DOWNLOAD_FILE_ACCEL_PREFIX is set (X-Accel-Redirect),
+    otherwise send_file hands them to the server's sendfile, answering Range requests and
+    conditional GETs with 206 and 304
+    """
+    download = Download.query.get_or_404(download_id)
+    if download.user_id != session.get('user_id'):
+        abort(403)
+    if download.status != 'completed' or not download.file_path:
+        abort(404)
+    
+    path = resolve_download_file(download.file_path)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    filename = os.path.basename(path)
+    # Stored files are named by content hash and may be compressed; the client gets plain JSON
+    download_name = f"{download.download_type}_{download.portal_id}_{download.id}.json"
+    compression = download.compression
+    encoding = content_encoding(compression)
+    send_encoded = encoding is not None and request.accept_encodings.quality(encoding) > 0
+    
+    if encoding and not send_encoded:
+        etag = make_etag('download-file', download.id, download.file_path, 'identity')
+        response = not_modified(etag)
+        if response is None:
+            def decompressed():
+                with open_stored_file(path, compression) as stored:
+                    while True:
+                        block = stored.read(64 * 1024)
+                        if not block:
+                            break
+                        yield block
+            
+            response = Response(decompressed(), mimetype='application/json')
+            response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+            if download.content_size:
+                response.content_length = download.content_size
+            response.set_etag(etag)
+            record_bytes_read(download.id, os.path.getsize(path))
+    elif app.config['DOWNLOAD_FILE_ACCEL_PREFIX'] and not encoding:
+        # nginx would not pass on a Content-Encoding, so compressed files go through send_file
+        response = Response(mimetype='application/json')
+        response.headers['X-Accel-Redirect'] = f"{app.config['DOWNLOAD_FILE_ACCEL_PREFIX'].rstrip('/')}/{filename}"
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        record_bytes_read(download.id, os.path.getsize(path))
+    else:
+        response = send_file(path, mimetype='application/json', as_attachment=True,
+                             download_name=download_name, conditional=True, etag=True)
+        if response.status_code in (200, 206):
+            record_bytes_read(download.id, response.content_length)
+    
+    if encoding:
+        if send_encoded and response.status_code != 304:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+    # A finished file never changes; only the owner's browser may keep it
+    response.headers['Cache-Control'] = f"private, max-age={app.config['DOWNLOAD_FILE_MAX_AGE']}"
+    return response
+
+@app.route('/api/download-status/<int:download_id>')
+@login_required
+def download_status(download_id):
+    """API endpoint to get the current status of a download"""
+    user_id = session.get('user_id')
+    
+    # Running downloads are answered from the live progress store without touching the database
+    live = get_progress_store().get(download_id)
+    if live:
+        if live['user_id'] != user_id:
+            return jsonify({'error': 'Unauthorized access'}), 403
+        payload = live_status_payload(live)
+        etag = make_etag('download', download_id, payload['status'], payload['progress'], payload['estimated_completion'])
+        return not_modified(etag) or with_etag(jsonify(payload), etag)
+    
+    # Check the version with a narrow query before loading and serializing the whole row
+    version = db.session.query(
+        Download.user_id, Download.status, Download.progress, Download.created_at, Download.updated_at
+    ).filter(Download.id == download_id).first()
+    if version is None:
+        abort(404)
+    
+    # Ensure the download belongs to the logged-in user
+    if version.user_id != user_id:
+        return jsonify({'error': 'Unauthorized access'}), 403
+    
+    estimated_completion = estimate_completion(version.status, version.progress, version.created_at)
+    etag = make_etag('download', download_id, version.status, version.progress, estimated_completion, version.updated_at)
+    response = not_modified(etag)
+    if response:
+        return response
+    
+    download = Download.query.get_or_404(download_id)
+    return with_etag(jsonify(download_status_payload(download)), etag)
+
+@app.route('/api/download-status/batch', methods=['POST'])
+@login_required
+def download_status_batch():
+    """
+    API endpoint to get the current status of many downloads at once
+    Expects {"download_ids": [...]}; returns each status keyed by id, with the
+    same schema as /api/download-status/<id>, plus an error for ids that can't be shown
+    """
+    user_id = session.get('user_id')
+    data = request.get_json(silent=True) or {}
+    download_ids = data.get('download_ids')
+    
+    # JSON true and false decode to bools, which are ints too
+    if not isinstance(download_ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in download_ids):
+        return jsonify({'error': 'download_ids must be a list of integers'}), 400
+    if len(download_ids) > app.config['DOWNLOAD_STATUS_BATCH_LIMIT']:
+        return jsonify({'error': f"At most {app.config['DOWNLOAD_STATUS_BATCH_LIMIT']} downloads per request"}), 400
+    
+    statuses = {}
+    errors = {}
+    requested = set(download_ids)
+    
+    # Running downloads come from the live progress store, everything else from one IN query
+    for download_id, live in get_progress_store().get_many(requested).items():
+        if live['user_id'] == user_id:
+            statuses[download_id] = live_status_payload(live)
+        else:
+            errors[download_id] = 'Unauthorized access'
+    
+    remaining = requested - statuses.keys() - errors.keys()
+    if remaining:
+        for download in Download.query.filter(Download.id.in_(remaining)):
+            if download.user_id == user_id:
+                statuses[download.id] = download_status_payload(download)
+            else:
+                errors[download.id] = 'Unauthorized access'
+    
+    for download_id in requested - statuses.keys() - errors.keys():
+        errors[download_id] = 'Not found'
+    
+    return jsonify({'downloads': statuses, 'errors': errors})
+
+_event_stream_slots = None
+_event_stream_slots_lock = threading.Lock()
+
+def get_event_stream_slots():
+    """Return the semaphore limiting this process to DOWNLOAD_EVENTS_MAX_STREAMS open event streams"""
+    global _event_stream_slots
+    with _event_stream_slots_lock:
+        if _event_stream_slots is None:
+            _event_stream_slots = threading.BoundedSemaphore(app.config['DOWNLOAD_EVENTS_MAX_STREAMS'])
+        return _event_stream_slots
+
+@app.route('/api/download-events')
+@login_required
+def download_events():
+    """
+    Server-Sent Events stream of state changes and progress for all of the user's active downloads
+    Running downloads are read from the live progress store; the database is only
+    consulted when a download leaves it and every DOWNLOAD_EVENTS_REFRESH_SECONDS
+    Each stream holds a server thread, so past DOWNLOAD_EVENTS_MAX_STREAMS per process the
+    request is answered with a 503, on which the browser falls back to polling
+    """
+    slots = get_event_stream_slots()
+    if not slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many open event streams, poll /api/download-status instead'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    
+    user_id = session.get('user_id')
+    store = get_progress_store()
+    interval = app.config['DOWNLOAD_EVENTS_INTERVAL']
+    
+    def load_downloads(download_ids=None):
+        query = Download.query.filter_by(user_id=user_id)
+        if download_ids is None:
+            query = query.filter(Download.status.in_(['scheduled', 'in_progress']))
+        else:
+            query = query.filter(Download.id.in_(download_ids))
+        downloads = {download.id: download_status_payload(download) for download in query}
+        # Don't hold a pooled connection between ticks
+        db.session.remove()
+        return downloads
+    
+    def stream():
+        yield 'retry: 3000\n\n'
+        
+        started = time.monotonic()
+        next_refresh = started + app.config['DOWNLOAD_EVENTS_REFRESH_SECONDS']
+        last_event = started
+        sent = {}
+        db_payloads = load_downloads()
+        tracked = set(db_payloads)
+        previously_live = set()
+        
+        while time.monotonic() - started < app.config['DOWNLOAD_EVENTS_MAX_SECONDS']:
+            payloads = {
+                entry['download_id']: live_status_payload(entry)
+                for entry in store.get_for_user(user_id)
+            }
+            tracked |= payloads.keys()
+            
+            # Downloads that just left the live store have changed state; so has anything
+            # scheduled since the last refresh
+            stale = (previously_live - payloads.keys()) & tracked
+            if time.monotonic() >= next_refresh:
+                next_refresh = time.monotonic() + app.config['DOWNLOAD_EVENTS_REFRESH_SECONDS']
+                db_payloads = load_downloads()
+                tracked |= db_payloads.keys()
+            elif stale:
+                db_payloads.update(load_downloads(stale))
+            previously_live = set(payloads)
+            
+            for download_id in tracked - payloads.keys():
+                if download_id in db_payloads:
+                    payloads[download_id] = db_payloads[download_id]
+            
+            for download_id, payload in sorted(payloads.items()):
+                state = (payload['status'], payload['progress'], payload['estimated_completion'])
+                if sent.get(download_id) != state:
+                    sent[download_id] = state
+                    last_event = time.monotonic()
+                    yield f"event: download\ndata: {json.dumps(dict(payload, download_id=download_id))}\n\n"
+                if payload['status'] in ('completed', 'failed'):
+                    tracked.discard(download_id)
+                    db_payloads.pop(download_id, None)
+            
+            if not tracked:
+                # Nothing left to watch; tell the client so it doesn't reconnect
+                yield 'event: idle\ndata: {}\n\n'
+                return
+            
+            if time.monotonic() - last_event >= 15:
+                last_event = time.monotonic()
+                yield ': keepalive\n\n'
+            time.sleep(interval)
+    
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Released once the stream ends or the client goes away
+    response.call_on_close(slots.release)
+    return response
+
+@app.route('/api/worker-pool')
+@admin_required
+def api_worker_pool():
+    """API endpoint to inspect the background download worker pool"""
+    return jsonify(get_worker_pool().stats())
+
+@app.route('/api/download-storage')
+@admin_required
+def api_download_storage():
+    """API endpoint summing the disk and I/O used by stored result files, per download type and compression"""
+    rows = db.session.query(
+        Download.download_type,
+        Download.compression,
+        func.count(Download.id),
+        func.sum(Download.file_size),
+        func.sum(Download.content_size),
+        func.sum(Download.bytes_read)
+    ).filter(Download.file_size.isnot(None)).group_by(Download.download_type, Download.compression).all()
+    
+    # Downloads with identical content share one file, so the disk actually used is per stored file
+    store_files, store_bytes, store_refs = db.session.query(
+        func.count(StoredFile.file_path),
+        func.sum(StoredFile.file_size),
+        func.sum(StoredFile.ref_count)
+    ).one()
+    
+    return jsonify({
+        'storage': [
+            {
+                'download_type': download_type,
+                'compression': compression or 'none',
+                'files': files,
+                'stored_bytes': int(stored_bytes or 0),
+                'content_bytes': int(content_bytes or 0),
+                'bytes_read': int(bytes_read or 0)
+            }
+            for download_type, compression, files, stored_bytes, content_bytes, bytes_read in rows
+        ],
+        'store': {
+            'files': store_files,
+            'stored_bytes': int(store_bytes or 0),
+            'references': int(store_refs or 0)
+        }
     })
 
 @app.route('/api/portals')
 @login_required
 def api_portals():
     """API endpoint to get all portals"""
-    portals = Portal.query.all()
+    # Any add, edit or delete bumps the catalogue version
+    etag = make_etag('portals', get_portal_catalogue_version())
+    response = not_modified(etag)
+    if response:
+        return response
+    
+    portals = get_portals()
     portal_list = [
         {
             'id': portal.id,
@@ -464,13 +1038,25 @@ def api_portals():
         }
         for portal in portals
     ]
-    return jsonify({'portals': portal_list})
+    return with_etag(jsonify({'portals': portal_list}), etag)
 
 @app.route('/api/portal/<int:portal_id>')
 @login_required
 def api_portal_details(portal_id):
     """API endpoint to get details of a specific portal"""
     user_id = session.get('user_id')
+    
+    portal_version = db.session.query(Portal.updated_at).filter(Portal.id == portal_id).first()
+    if portal_version is None:
+        abort(404)
+    credential_version = db.session.query(Credential.id, Credential.updated_at).filter_by(
+        user_id=user_id, portal_id=portal_id
+    ).first()
+    etag = make_etag('portal', portal_id, portal_version.updated_at, *(credential_version or ()))
+    response = not_modified(etag)
+    if response:
+        return response
+    
     portal = Portal.query.get_or_404(portal_id)
     
     # Get user's credential for this portal if it exists
@@ -485,7 +1071,7 @@ def api_portal_details(portal_id):
             'updated_at': credential.updated_at.isoformat()
         }
     
-    return jsonify({
+    return with_etag(jsonify({
         'portal': {
             'id': portal.id,
             'name': portal.name,
@@ -494,4 +1080,4 @@ def api_portal_details(portal_id):
             'created_at': portal.created_at.isoformat()
         },
         'credential': credential_info
-    })
+    }), etag)
@@ -1,11 +1,21 @@
 #!/bin/bash
 
+# Bring the database schema up to date
+echo "Applying database migrations..."
+python -m migrations || exit 1
+
 # Start the Flask app
 echo "Starting Flask application..."
-gunicorn --bind 0.0.0.0:5000 --reuse-port --reload main:app &
+gunicorn --bind 0.0.0.0:5000 --reuse-port --reload --threads 8 main:app &
 FLASK_PID=$!
 echo "Flask application running with PID $FLASK_PID"
 
+# Start the download worker
+echo "Starting download worker..."
+python -m worker &
+WORKER_PID=$!
+echo "Download worker running with PID $WORKER_PID"
+
 # Wait a bit to make sure Flask is up
 sleep 3
 
@@ -18,7 +28,7 @@ echo "Streamlit application running with PID $STREAMLIT_PID"
 # Function to handle termination
 cleanup() {
     echo "Stopping applications..."
-    kill $FLASK_PID $STREAMLIT_PID
+    kill $FLASK_PID $WORKER_PID $STREAMLIT_PID
     exit 0
 }
 
@@ -26,5 +36,5 @@ cleanup() {
 trap cleanup SIGINT SIGTERM
 
 # Keep the script running
-echo "Both applications are running. Press Ctrl+C to stop."
+echo "All applications are running. Press Ctrl+C to stop."
 wait
\ No newline at end of file
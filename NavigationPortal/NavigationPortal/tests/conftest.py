@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app reads its settings from the environment on import, so point it at a scratch database first
+_scratch = tempfile.mkdtemp(prefix='navigationportal-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_scratch, 'test.db')}"
+os.environ['PROGRESS_STORE_PATH'] = os.path.join(_scratch, 'progress.db')
+os.environ['DOWNLOAD_STORAGE_DIR'] = os.path.join(_scratch, 'downloads')
+os.environ['DOWNLOAD_EMBEDDED_WORKERS'] = '0'
+# Tests that need the shared identity counter rechecked set the interval themselves
+os.environ['IDENTITY_CACHE_VERSION_INTERVAL'] = '3600'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import configure_app, db
+    from migrations import upgrade
+
+    app = configure_app({'TESTING': True})
+    with app.app_context():
+        upgrade()
+    yield app
+    with app.app_context():
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,55 @@
+"""Rows and sessions shared by the tests"""
+import itertools
+from datetime import date
+
+from werkzeug.security import generate_password_hash
+
+from app import db
+from models import Credential, Download, Portal, User
+
+_names = itertools.count(1)
+
+
+def add_user(username=None, is_admin=False):
+    username = username or f'user{next(_names)}'
+    user = User(username=username, email=f'{username}@example.com', is_admin=is_admin,
+                password_hash=generate_password_hash('password'))
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+def add_portal(**limits):
+    portal = Portal(name=f'portal{next(_names)}', url='https://portal.example.com', **limits)
+    db.session.add(portal)
+    db.session.commit()
+    return portal
+
+def add_credential(user, portal):
+    credential = Credential(user_id=user.id, portal_id=portal.id, username='facility',
+                            password_hash=generate_password_hash('secret'))
+    db.session.add(credential)
+    db.session.commit()
+    return credential
+
+def add_download(credential, **fields):
+    fields.setdefault('start_date', date(2024, 1, 1))
+    fields.setdefault('end_date', date(2024, 1, 1))
+    download = Download(user_id=credential.user_id, portal_id=credential.portal_id,
+                        credential_id=credential.id, facility_username='facility', **fields)
+    db.session.add(download)
+    db.session.commit()
+    return download
+
+def clear_queue():
+    """Fail whatever earlier tests left scheduled or running, so the queue holds only a test's own downloads"""
+    Download.query.filter(Download.status.in_(['scheduled', 'in_progress'])).update(
+        {'status': 'failed'}, synchronize_session=False
+    )
+    db.session.commit()
+
+def sign_in(client, user):
+    with client.session_transaction() as session:
+        session['user_id'] = user.id
+        session['username'] = user.username
+        session['is_admin'] = bool(user.is_admin)
+        session['account_version'] = user.account_version or 0
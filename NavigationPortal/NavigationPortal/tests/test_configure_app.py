@@ -0,0 +1,13 @@
+"""configure_app is a one-shot setup of the module's application, not a factory"""
+import pytest
+
+from app import configure_app
+
+
+def test_later_calls_return_the_configured_app(app):
+    assert configure_app() is app
+
+def test_config_after_configuration_is_refused(app):
+    with pytest.raises(RuntimeError):
+        configure_app({'TESTING': False})
+    assert app.config['TESTING'] is True
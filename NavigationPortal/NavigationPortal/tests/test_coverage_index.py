@@ -0,0 +1,78 @@
+"""Per-day coverage index: which recorded days are reused, and how long they are kept"""
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from app import db
+from coverage_index import covered_days, prune_coverage, record_coverage
+from download_scheduler import plan_delta_chunks
+from models import CoverageDay
+from helpers import add_credential, add_portal, add_user
+
+
+@pytest.fixture
+def credential(app):
+    with app.app_context():
+        yield add_credential(add_user(), add_portal())
+
+
+def record(credential, day, fetched_at=None):
+    assert record_coverage(credential.portal_id, credential.id, 'facility', 'submission', day, day,
+                           [{'date': day.isoformat()}])
+    if fetched_at is not None:
+        CoverageDay.query.filter_by(credential_id=credential.id, day=day).update({'fetched_at': fetched_at})
+        db.session.commit()
+
+def recorded_days(credential_id):
+    return {row.day for row in CoverageDay.query.filter_by(credential_id=credential_id)}
+
+def days(first, last):
+    return {date(2024, 1, day) for day in range(first, last + 1)}
+
+def test_plan_splits_around_covered_days():
+    chunks, covered_chunks = plan_delta_chunks(date(2024, 1, 1), date(2024, 1, 20), 7, days(3, 12))
+    assert chunks == [
+        (date(2024, 1, 1), date(2024, 1, 2)),
+        (date(2024, 1, 3), date(2024, 1, 9)),
+        (date(2024, 1, 10), date(2024, 1, 12)),
+        (date(2024, 1, 13), date(2024, 1, 19)),
+        (date(2024, 1, 20), date(2024, 1, 20)),
+    ]
+    assert covered_chunks == {(date(2024, 1, 3), date(2024, 1, 9)), (date(2024, 1, 10), date(2024, 1, 12))}
+
+def test_plan_of_a_fully_covered_or_uncovered_range():
+    start, end = date(2024, 1, 1), date(2024, 1, 5)
+    assert plan_delta_chunks(start, end, 7, set()) == ([(start, end)], set())
+    assert plan_delta_chunks(start, end, 7, days(1, 5)) == ([(start, end)], {(start, end)})
+
+def test_days_inside_the_mutable_window_are_fetched_again(app, credential):
+    window = app.config['DOWNLOAD_MUTABLE_WINDOW_DAYS']
+    settled = date.today() - timedelta(days=10)
+    unsettled = settled + timedelta(days=1)
+    # Fetched exactly window days after it: settled. Fetched one day sooner: the portal may still change it
+    fetched_at = datetime.combine(settled + timedelta(days=window), datetime.min.time())
+    record(credential, settled, fetched_at=fetched_at)
+    record(credential, unsettled, fetched_at=fetched_at)
+
+    assert covered_days(credential.id, 'facility', 'submission', settled, unsettled) == {settled}
+    assert covered_days(credential.id, 'facility', 'submission', settled, settled) == {settled}
+    assert covered_days(credential.id, 'other', 'submission', settled, unsettled) == set()
+
+def test_prune_drops_days_past_retention(app, credential):
+    retention = app.config['DOWNLOAD_COVERAGE_RETENTION_DAYS']
+    old, recent = date(2024, 1, 1), date(2024, 1, 2)
+    record(credential, old, fetched_at=datetime.utcnow() - timedelta(days=retention + 1))
+    record(credential, recent)
+
+    assert prune_coverage() == 1
+    assert recorded_days(credential.id) == {recent}
+
+def test_prune_drops_days_of_deleted_credentials(credential):
+    record(credential, date(2024, 1, 1))
+    credential_id = credential.id
+    # Deleted behind the ORM's back, as rows recorded before coverage cascaded with credentials were
+    db.session.execute(db.text('DELETE FROM credential WHERE id = :id'), {'id': credential_id})
+    db.session.commit()
+
+    assert prune_coverage() == 1
+    assert recorded_days(credential_id) == set()
@@ -0,0 +1,71 @@
+"""The content-addressed result store: canonical hashing, shared references and collection"""
+import os
+from datetime import date
+
+import pytest
+
+from app import db
+from download_output import collect_unreferenced_files, open_download_file, record_download_file, resolve_download_file
+from models import Download, StoredFile
+from helpers import add_credential, add_download, add_portal, add_user
+
+
+def header(**fields):
+    return dict({'portal_url': 'https://portal.example.com', 'download_type': 'submission', 'timestamp': 'now'}, **fields)
+
+def write(items, document_header=None):
+    writer = open_download_file(document_header or header())
+    writer.write_items(items)
+    writer.close()
+    return writer
+
+def store(download_id, items):
+    writer = write(items)
+    assert record_download_file(download_id, writer.file_name, writer)
+    writer.publish()
+    return writer.file_name
+
+@pytest.fixture
+def downloads(app):
+    with app.app_context():
+        credential = add_credential(add_user(), add_portal())
+        yield [add_download(credential, status='completed').id for _ in range(3)]
+
+
+def test_hash_ignores_key_order_and_timestamp(app):
+    with app.app_context():
+        first = write([{'b': 1, 'a': {'y': 2, 'x': 3}}], header(timestamp='monday'))
+        second = write([{'a': {'x': 3, 'y': 2}, 'b': 1}],
+                       {'download_type': 'submission', 'timestamp': 'tuesday', 'portal_url': 'https://portal.example.com'})
+        different = write([{'a': {'x': 3, 'y': 2}, 'b': 2}])
+        for writer in (first, second, different):
+            writer.abort()
+    assert first.content_hash == second.content_hash
+    assert different.content_hash != first.content_hash
+
+def test_shared_file_lives_until_its_last_download_is_deleted(downloads):
+    shared_a, shared_b, other = downloads
+    items = [{'date': date(2024, 1, 1).isoformat(), 'amount': 1}]
+    file_path = store(shared_a, items)
+    assert store(shared_b, items) == file_path
+    other_path = store(other, [{'amount': 2}])
+    assert db.session.get(StoredFile, file_path).ref_count == 2
+
+    db.session.delete(db.session.get(Download, shared_a))
+    db.session.commit()
+    db.session.expire_all()
+    assert db.session.get(StoredFile, file_path).ref_count == 1
+    assert collect_unreferenced_files() == 0
+    assert os.path.exists(resolve_download_file(file_path))
+
+    db.session.delete(db.session.get(Download, shared_b))
+    db.session.commit()
+    db.session.expire_all()
+    assert db.session.get(StoredFile, file_path).ref_count == 0
+    assert collect_unreferenced_files() == 1
+    assert db.session.get(StoredFile, file_path) is None
+    assert not os.path.exists(resolve_download_file(file_path))
+
+    # The file still referenced is left alone
+    assert db.session.get(StoredFile, other_path).ref_count == 1
+    assert os.path.exists(resolve_download_file(other_path))
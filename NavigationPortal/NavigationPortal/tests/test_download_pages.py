@@ -0,0 +1,60 @@
+"""Keyset pagination of a user's downloads"""
+import base64
+from datetime import datetime, timedelta
+
+import pytest
+
+from helpers import add_credential, add_download, add_portal, add_user, sign_in
+
+
+@pytest.fixture
+def history(app, client):
+    """Seven downloads, newest first; the middle three share a created_at"""
+    with app.app_context():
+        user = add_user()
+        credential = add_credential(user, add_portal())
+        base = datetime(2024, 6, 1, 12)
+        created = [base + timedelta(minutes=offset) for offset in (2, 1, 0, 0, 0, -1, -2)]
+        ids = [add_download(credential, created_at=created_at, status='completed').id for created_at in created]
+        sign_in(client, user)
+    # Downloads sharing a created_at come newest id first
+    return ids[:2] + sorted(ids[2:5], reverse=True) + ids[5:]
+
+
+def page(client, **args):
+    response = client.get('/api/downloads', query_string=args)
+    assert response.status_code == 200
+    body = response.get_json()
+    return [download['id'] for download in body['downloads']], body['next_cursor']
+
+def test_pages_walk_every_download_once(client, history):
+    seen, cursor, pages = [], None, 0
+    while True:
+        ids, cursor = page(client, limit=2, **({'cursor': cursor} if cursor else {}))
+        seen.extend(ids)
+        pages += 1
+        if cursor is None:
+            break
+    assert seen == history
+    assert pages == 4
+
+def test_page_boundary_inside_a_created_at_tie(client, history):
+    # The first page ends on the first of three downloads sharing a created_at
+    first, cursor = page(client, limit=3)
+    second, _ = page(client, limit=3, cursor=cursor)
+    assert first == history[:3]
+    assert second == history[3:6]
+
+def encode(text):
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+@pytest.mark.parametrize('cursor', [
+    'not a cursor!',
+    encode('no separator'),
+    encode('yesterday|1'),
+    encode('2024-06-01T12:00:00|one'),
+    base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+])
+def test_malformed_cursor_is_rejected(client, history, cursor):
+    response = client.get('/api/downloads', query_string={'cursor': cursor})
+    assert response.status_code == 400
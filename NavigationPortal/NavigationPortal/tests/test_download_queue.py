@@ -0,0 +1,109 @@
+"""The database-backed download queue: claims, lease renewal and reclaiming from dead workers"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from app import db
+from download_scheduler import claim_next_download, reclaim_expired_leases, release_lease, renew_leases
+from models import Download
+from helpers import add_credential, add_download, add_portal, add_user, clear_queue
+
+
+@pytest.fixture
+def queued(app):
+    """Two scheduled downloads, oldest first, in an otherwise empty queue"""
+    with app.app_context():
+        clear_queue()
+        credential = add_credential(add_user(), add_portal())
+        first = add_download(credential, status='scheduled', created_at=datetime.utcnow() - timedelta(minutes=1))
+        second = add_download(credential, status='scheduled')
+        yield first.id, second.id
+
+
+def lease_of(download_id):
+    db.session.expire_all()
+    download = db.session.get(Download, download_id)
+    return download.lease_owner, download.lease_expires_at
+
+def expire_lease(download_id, **fields):
+    Download.query.filter_by(id=download_id).update(
+        dict(fields, lease_expires_at=datetime.utcnow() - timedelta(seconds=1)), synchronize_session=False
+    )
+    db.session.commit()
+
+def test_two_workers_claim_different_downloads(queued):
+    first, second = queued
+    assert claim_next_download('worker-a', 60) == first
+    assert claim_next_download('worker-b', 60) == second
+    assert claim_next_download('worker-c', 60) is None
+    assert lease_of(first)[0] == 'worker-a'
+    assert lease_of(second)[0] == 'worker-b'
+
+def test_claim_lost_to_another_worker_moves_on(app, queued):
+    """
+    Without SKIP LOCKED (SQLite) two workers can pick the same candidate; the conditional
+    UPDATE lets only one of them have it, and the other takes the next candidate
+    """
+    first, second = queued
+    raced = []
+
+    def claim_first_elsewhere(conn, cursor, statement, parameters, context, executemany):
+        if raced or not statement.startswith('UPDATE download'):
+            return
+        raced.append(True)
+        with db.engine.begin() as other:
+            other.execute(Download.__table__.update().where(Download.id == first).values(
+                lease_owner='worker-a', lease_expires_at=datetime.utcnow() + timedelta(seconds=60)
+            ))
+
+    event.listen(db.engine, 'before_cursor_execute', claim_first_elsewhere)
+    try:
+        assert claim_next_download('worker-b', 60) == second
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', claim_first_elsewhere)
+    assert raced
+    assert lease_of(first)[0] == 'worker-a'
+    assert lease_of(second)[0] == 'worker-b'
+
+def test_heartbeat_renews_only_the_workers_own_leases(queued):
+    first, second = queued
+    claim_next_download('worker-a', 5)
+    claim_next_download('worker-b', 5)
+    _, first_expiry = lease_of(first)
+    _, second_expiry = lease_of(second)
+
+    assert renew_leases('worker-a', [first, second], 60) == 1
+    assert lease_of(first)[1] > first_expiry + timedelta(seconds=30)
+    assert lease_of(second)[1] == second_expiry
+
+def test_lapsed_claim_is_taken_by_another_worker(queued):
+    first, _ = queued
+    claim_next_download('worker-a', 60)
+    # worker-a died between claiming the download and starting it
+    expire_lease(first)
+    assert claim_next_download('worker-b', 60) == first
+
+def test_expired_running_download_is_requeued_then_failed(queued):
+    first, _ = queued
+    claim_next_download('worker-a', 60)
+    expire_lease(first, status='in_progress')
+
+    assert reclaim_expired_leases(max_attempts=3) == 1
+    db.session.expire_all()
+    download = db.session.get(Download, first)
+    assert (download.status, download.lease_owner) == ('scheduled', None)
+
+    assert claim_next_download('worker-b', 60) == first
+    expire_lease(first, status='in_progress')
+    assert reclaim_expired_leases(max_attempts=2) == 1
+    db.session.expire_all()
+    assert db.session.get(Download, first).status == 'failed'
+
+def test_released_lease_is_dropped(queued):
+    first, _ = queued
+    claim_next_download('worker-a', 60)
+    release_lease('worker-b', first)
+    assert lease_of(first)[0] == 'worker-a'
+    release_lease('worker-a', first)
+    assert lease_of(first) == (None, None)
@@ -0,0 +1,38 @@
+"""Authorization from the identity cache, and role changes reaching other processes"""
+from app import db
+from identity_cache import _get_identity_cache, bump_account_version
+from models import User
+from query_budget import query_budget
+from helpers import add_user, sign_in
+
+
+def test_conditional_get_authorizes_without_queries(app, client):
+    with app.app_context():
+        sign_in(client, add_user())
+    etag = client.get('/api/portals').headers['ETag']
+
+    with query_budget(0):
+        response = client.get('/api/portals', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+def test_demotion_in_another_process_applies_after_the_version_interval(app, client):
+    with app.app_context():
+        admin = add_user(is_admin=True)
+        sign_in(client, admin)
+        admin_id = admin.id
+    assert client.get('/user-management').status_code == 200
+
+    # Demote without touching this process's cache, as another gunicorn worker would
+    with app.app_context():
+        user = db.session.get(User, admin_id)
+        user.is_admin = False
+        bump_account_version(user)
+        db.session.commit()
+
+    cache = _get_identity_cache()
+    interval = cache.version_interval
+    cache.version_interval = 0
+    try:
+        assert client.get('/user-management').status_code == 302
+    finally:
+        cache.version_interval = interval
@@ -0,0 +1,31 @@
+"""Validation of the portal limit fields, and limits that slipped past it"""
+import pytest
+
+from app import db
+from download_scheduler import claim_next_download
+from models import Portal
+from portal_cache import clear_portal_cache
+from portal_throttle import download_cap
+from helpers import add_credential, add_download, add_portal, add_user, clear_queue, sign_in
+
+
+@pytest.mark.parametrize('value', ['inf', 'nan', '-inf'])
+def test_non_finite_rate_limit_is_rejected(app, client, value):
+    with app.app_context():
+        sign_in(client, add_user())
+    response = client.post('/add-portal', data={
+        'name': f'rate {value}', 'url': 'https://portal.example.com', 'rate_limit': value
+    })
+    assert response.status_code == 302
+    with app.app_context():
+        assert Portal.query.filter_by(name=f'rate {value}').first() is None
+
+@pytest.mark.parametrize('value', [float('inf'), float('nan')])
+def test_non_finite_stored_limit_counts_as_unlimited(app, value):
+    assert download_cap(value, None, None) is None
+    with app.app_context():
+        clear_queue()
+        credential = add_credential(add_user(), add_portal(rate_limit=value))
+        download = add_download(credential, status='scheduled')
+        clear_portal_cache()
+        assert claim_next_download('worker-a', 60) == download.id
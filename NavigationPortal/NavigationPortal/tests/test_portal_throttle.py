@@ -0,0 +1,73 @@
+"""Portal request slots: held per download, renewed with its lease, reclaimed when it lapses"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from download_scheduler import release_lease, renew_leases
+from models import PortalRequestSlot
+from portal_throttle import PortalSlotTimeout, portal_request_slot, reclaim_expired_slots, try_acquire
+from helpers import add_credential, add_download, add_portal, add_user
+
+
+@pytest.fixture
+def capped(app):
+    """A portal allowing one request at a time, with two downloads from it"""
+    with app.app_context():
+        portal = add_portal(max_concurrent_requests=1)
+        credential = add_credential(add_user(), portal)
+        first = add_download(credential, status='in_progress', lease_owner='worker-a')
+        second = add_download(credential, status='in_progress', lease_owner='worker-b')
+        yield portal.id, first.id, second.id
+
+
+def acquire(portal_id, download_id):
+    return try_acquire(portal_id, download_id, None, None, 1)
+
+def test_cap_holds_until_the_slot_is_released(capped):
+    portal_id, first, second = capped
+    wait, slot_id = acquire(portal_id, first)
+    assert wait == 0 and slot_id is not None
+    wait, _ = acquire(portal_id, second)
+    assert wait > 0
+
+    release_lease('worker-a', first)
+    assert acquire(portal_id, second)[0] == 0
+
+def test_slot_of_a_dead_worker_is_reclaimed_once_it_expires(capped):
+    portal_id, first, second = capped
+    _, leaked = acquire(portal_id, first)
+    # The worker holding it stops renewing, so the slot lapses with its lease
+    PortalRequestSlot.query.filter_by(id=leaked).update({'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+
+    assert acquire(portal_id, second)[0] == 0
+    assert reclaim_expired_slots() == 1
+    assert db.session.get(PortalRequestSlot, leaked) is None
+
+def test_heartbeat_keeps_the_slots_of_running_downloads(capped):
+    portal_id, first, _ = capped
+    _, slot_id = acquire(portal_id, first)
+    PortalRequestSlot.query.filter_by(id=slot_id).update({'expires_at': datetime.utcnow() + timedelta(seconds=1)})
+    db.session.commit()
+
+    renew_leases('worker-a', [first], 60)
+    assert reclaim_expired_slots() == 0
+    assert db.session.get(PortalRequestSlot, slot_id).expires_at > datetime.utcnow() + timedelta(seconds=30)
+
+def test_waiting_for_a_slot_is_bounded(app, capped):
+    portal_id, first, second = capped
+    acquire(portal_id, first)
+
+    async def request():
+        async with portal_request_slot(portal_id, second, max_concurrent_requests=1):
+            pass
+
+    timeout = app.config['PORTAL_SLOT_WAIT_TIMEOUT']
+    app.config['PORTAL_SLOT_WAIT_TIMEOUT'] = 0.1
+    try:
+        with pytest.raises(PortalSlotTimeout):
+            asyncio.run(request())
+    finally:
+        app.config['PORTAL_SLOT_WAIT_TIMEOUT'] = timeout
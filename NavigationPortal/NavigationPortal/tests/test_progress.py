@@ -0,0 +1,65 @@
+"""Live progress entries leave the store before a download's final status is written"""
+from datetime import datetime
+
+import pytest
+
+from app import db
+from models import Download
+from progress import ProgressFlusher, get_progress_store
+from helpers import add_credential, add_download, add_portal, add_user, sign_in
+
+
+@pytest.fixture
+def flusher(app):
+    # Flushed by hand; the background thread never wakes up during a test
+    return ProgressFlusher(flush_interval=3600, store=get_progress_store(), refresh_interval=3600)
+
+@pytest.fixture
+def running(app):
+    with app.app_context():
+        user = add_user()
+        download = add_download(add_credential(user, add_portal()), status='in_progress', progress=20)
+        yield user, download.id
+
+
+def publish(flusher, user, download_id, progress):
+    flusher.publish(download_id, progress, {
+        'download_id': download_id, 'user_id': user.id, 'download_type': 'submission',
+        'facility_username': 'facility', 'created_at': datetime.utcnow(), 'started_at': datetime.utcnow()
+    })
+
+def test_discard_unpublishes_at_once(flusher, running):
+    user, download_id = running
+    publish(flusher, user, download_id, 90)
+    flusher.flush()
+    assert get_progress_store().get(download_id)['progress'] == 90
+
+    # Published but not yet flushed when the download finishes; a later flush must not bring it back
+    publish(flusher, user, download_id, 95)
+    flusher.discard(download_id)
+    assert get_progress_store().get(download_id) is None
+    flusher.flush()
+    assert get_progress_store().get(download_id) is None
+
+def test_finished_download_reports_its_final_status(app, client, flusher, running):
+    user, download_id = running
+    publish(flusher, user, download_id, 90)
+    flusher.flush()
+    sign_in(client, user)
+
+    flusher.discard(download_id)
+    Download.query.filter_by(id=download_id).update({'status': 'completed', 'progress': 100})
+    db.session.commit()
+
+    payload = client.get(f'/api/download-status/{download_id}').get_json()
+    assert (payload['status'], payload['progress']) == ('completed', 100)
+
+def test_close_writes_pending_progress_and_unpublishes_everything(flusher, running):
+    user, download_id = running
+    publish(flusher, user, download_id, 60)
+    flusher.enqueue(download_id, 60)
+
+    flusher.close()
+    assert get_progress_store().get(download_id) is None
+    db.session.expire_all()
+    assert db.session.get(Download, download_id).progress == 60
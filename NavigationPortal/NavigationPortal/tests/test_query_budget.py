@@ -0,0 +1,56 @@
+"""
+Query budgets of the list pages
+
+Each page is loaded with a few rows and with many; the number of queries must
+stay within its budget and must not grow with the rows shown, which is what an
+N+1 regression (a lazy relationship loaded per row) would do.
+"""
+from datetime import date, timedelta
+
+import pytest
+
+from app import db
+from models import User
+from query_budget import count_queries, query_budget
+from helpers import add_credential, add_download, add_portal, add_user, sign_in
+
+
+def add_rows(user, portal_count, downloads_per_portal):
+    """Give a user one credential and downloads_per_portal downloads on each of portal_count new portals"""
+    for _ in range(portal_count):
+        credential = add_credential(user, add_portal())
+        for day in range(downloads_per_portal):
+            add_download(credential, start_date=date(2024, 1, 1) + timedelta(days=day),
+                         end_date=date(2024, 1, 1) + timedelta(days=day), status='completed', progress=100)
+
+def page_queries(client, path):
+    # The first request fills the identity and portal caches; count the one after it
+    assert client.get(path).status_code == 200
+    with count_queries() as statements:
+        assert client.get(path).status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize('path, budget', [
+    ('/download-history', 1),
+    ('/user-credentials', 1),
+])
+def test_list_pages_stay_within_budget(app, client, path, budget):
+    with app.app_context():
+        few = add_user()
+        add_rows(few, portal_count=1, downloads_per_portal=1)
+        many = add_user()
+        add_rows(many, portal_count=5, downloads_per_portal=8)
+        few, many = few.id, many.id
+
+    with app.app_context():
+        sign_in(client, db.session.get(User, few))
+    few_queries = page_queries(client, path)
+
+    with app.app_context():
+        sign_in(client, db.session.get(User, many))
+    page_queries(client, path)
+    with query_budget(budget) as statements:
+        assert client.get(path).status_code == 200
+
+    assert len(statements) == few_queries
@@ -0,0 +1,58 @@
+"""
+Standalone download worker
+
+Runs only the download engine, separately from the gunicorn web process,
+which just enqueues 'scheduled' downloads. Start as many as needed:
+
+    python -m worker --concurrency 8
+"""
+import argparse
+import logging
+import signal
+import threading
+
+from app import app, configure_app
+from download_scheduler import get_worker_pool
+from fetch_engine import get_fetch_engine
+from progress import get_progress_flusher
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process scheduled JSON downloads')
+    parser.add_argument('--concurrency', type=int, default=app.config['DOWNLOAD_MAX_WORKERS'],
+                        help='number of downloads to run at once')
+    parser.add_argument('--poll-interval', type=float, default=app.config['DOWNLOAD_POLL_INTERVAL'],
+                        help='seconds between queue polls when idle')
+    parser.add_argument('--shutdown-timeout', type=float, default=30,
+                        help='seconds to wait for running downloads on shutdown')
+    args = parser.parse_args()
+
+    configure_app({
+        'DOWNLOAD_MAX_WORKERS': args.concurrency,
+        'DOWNLOAD_POLL_INTERVAL': args.poll_interval
+    })
+
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_requested.set())
+
+    pool = get_worker_pool()
+    pool.start()
+    logging.info("Download worker %s started with concurrency %s", pool.worker_id, args.concurrency)
+
+    while not stop_requested.wait(60):
+        with app.app_context():
+            logging.info("Download worker stats: %s", pool.stats())
+
+    logging.info("Stopping download worker %s", pool.worker_id)
+    unfinished = pool.stop(timeout=args.shutdown_timeout)
+    if unfinished:
+        logging.warning("Downloads %s were still running and will be picked up by another worker", unfinished)
+    get_fetch_engine().stop()
+    # Nothing will republish the live progress of this worker's downloads, so don't leave it looking fresh
+    with app.app_context():
+        get_progress_flusher().close()
+
+
+if __name__ == "__main__":
+    main()